@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+
+Synthetic benchmark of the playbook output hot paths. A generated stream of results (hosts x tasks x loop items) is
+replayed through the runner and playbook callbacks, output channel and stats into a fake xmpp.msg_reply sink;
+nothing is run on real hosts, so the benchmark can run offline (e.g. in CI).
+
+Usage: python -m ludolph_ansible.benchmark [--hosts N] [--tasks N] [--items N] [--json] [--baseline FILE]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import json
+import time
+import random
+import timeit
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from six import iteritems, text_type
+
+from .output import OutputChannel
+from .playbook import DisplayCallback, FailureRender, ProgressRender, render, stringc, hostcolor
+from .playbook_callbacks import banner, AggregateStats, PlaybookCallbacks, PlaybookRunnerCallbacks
+
+
+class Sink(object):
+    """xmpp.msg_reply replacement which only counts messages"""
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def __call__(self, text):
+        if isinstance(text, text_type):
+            text = text.encode('utf-8')
+
+        self.messages += 1
+        self.bytes += len(text)
+
+
+class _Runner(object):
+    delegate_to = None
+
+
+def synthetic_results(hosts=100, tasks=20, items=0, changed=0.2, failed=0.01, unreachable=0.005, stdout_size=1024,
+                      seed=42):
+    """
+    Yield (task name, list of (callback name, host, result)) tuples. Hosts which failed or were unreachable are left
+    out of the following tasks like in ansible.
+    """
+    rnd = random.Random(seed)
+    stdout = '\n'.join('line %d of command output' % i for i in range(max(stdout_size // 26, 1)))[:stdout_size]
+    alive = ['host%05d.example.com' % i for i in range(hosts)]
+
+    for task_no in range(tasks):
+        task_results = []
+        dead = set()
+
+        for host in alive:
+            for item_no in range(items or 1):
+                r = rnd.random()
+                result = {
+                    'invocation': {'module_name': 'command', 'module_args': 'run something'},
+                    'cmd': 'run something',
+                    'rc': 0,
+                    'stdout': stdout,
+                    'stderr': '',
+                    'changed': False,
+                }
+
+                if items:
+                    result['item'] = 'item%d' % item_no
+
+                if r < unreachable:
+                    task_results.append(('on_unreachable', host, 'SSH Error: Connection timed out'))
+                    dead.add(host)
+                    break
+                elif r < unreachable + failed:
+                    result.update(failed=True, rc=1, stderr='error: something failed', msg='non-zero return code')
+                    task_results.append(('on_failed', host, result))
+                    dead.add(host)
+                    break
+                elif r < unreachable + failed + changed:
+                    result['changed'] = True
+
+                task_results.append(('on_ok', host, result))
+
+        yield 'benchmark task %d' % task_no, task_results
+        alive = [host for host in alive if host not in dead]
+
+
+def run(hosts=100, tasks=20, items=0, changed=0.2, failed=0.01, unreachable=0.005, stdout_size=1024, output='full',
+        verbose=0, max_size=16384, trace_memory=False):
+    """Replay one synthetic playbook run and return dict of measurements"""
+    results = list(synthetic_results(hosts=hosts, tasks=tasks, items=items, changed=changed, failed=failed,
+                                     unreachable=unreachable, stdout_size=stdout_size))
+    sink = Sink()
+    stats = AggregateStats()
+    if output == 'failures':
+        output_render = FailureRender()
+    elif output == 'progress':
+        output_render = ProgressRender()
+    else:
+        output_render = render
+
+    display = DisplayCallback(OutputChannel(sink, max_size=max_size, interval=3600, render=output_render))
+    callbacks = PlaybookCallbacks(verbose=verbose, display=display)
+    runner_callbacks = PlaybookRunnerCallbacks(stats, verbose=verbose, display=display.save)
+    runner_callbacks.runner = _Runner()
+    count = 0
+
+    if trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+
+    started = time.time()
+    callbacks.on_play_start('benchmark')
+
+    for task_name, task_results in results:
+        callbacks.on_task_start(task_name, False)
+        runner_results = {'contacted': {}, 'dark': {}}
+
+        for callback, host, result in task_results:
+            if callback == 'on_unreachable':
+                runner_callbacks.on_unreachable(host, result)
+                runner_results['dark'][host] = {'msg': result}
+            else:
+                getattr(runner_callbacks, callback)(host, result)
+                runner_results['contacted'][host] = result
+
+            count += 1
+
+        stats.compute(runner_results)
+
+    recap = [banner('PLAY RECAP')]
+
+    for host in sorted(stats.processed.keys()):
+        t = stats.summarize(host)
+        recap.append('%s : ok=%-4s changed=%-4s unreachable=%-4s failed=%-4s' % (
+            hostcolor(host, t), t['ok'], t['changed'], t['unreachable'], t['failures']))
+
+    display.close()
+    sink('\n'.join(recap))
+    elapsed = time.time() - started
+    res = {
+        'results': count,
+        'seconds': elapsed,
+        'results_per_second': count / elapsed if elapsed else None,
+        'messages': sink.messages,
+        'message_bytes': sink.bytes,
+        'traced_peak_bytes': None,
+        'traced_current_bytes': None,
+    }
+
+    if trace_memory and tracemalloc is not None:
+        res['traced_current_bytes'], res['traced_peak_bytes'] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    if resource is not None:
+        res['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return res
+
+
+def micro(number=10000):
+    """Return seconds per call of small functions used for every line or host"""
+    stats = AggregateStats()
+    runner_results = {'contacted': dict(('host%03d' % i, {'changed': bool(i % 2)}) for i in range(100)), 'dark': {}}
+    stats.compute(runner_results)
+    summary = stats.summarize('host001')
+    tests = (
+        ('stringc', lambda: stringc('changed: [host001.example.com] => (item=something)', 'orange')),
+        ('hostcolor', lambda: hostcolor('host001.example.com', summary)),
+        ('AggregateStats.compute (100 hosts)', lambda: stats.compute(runner_results)),
+        ('AggregateStats.summarize', lambda: stats.summarize('host001')),
+    )
+
+    return dict((name, timeit.timeit(fun, number=number) / number) for name, fun in tests)
+
+
+SCENARIOS = (
+    ('small', {'hosts': 10, 'tasks': 20}),
+    ('fleet', {'hosts': 1000, 'tasks': 10}),
+    ('loops', {'hosts': 100, 'tasks': 10, 'items': 20}),
+    ('large stdout failures', {'hosts': 200, 'tasks': 5, 'failed': 0.2, 'stdout_size': 65536}),
+    ('fleet, output=failures', {'hosts': 1000, 'tasks': 10, 'output': 'failures'}),
+    ('fleet, output=progress', {'hosts': 1000, 'tasks': 10, 'output': 'progress'}),
+)
+
+
+def _compare(report, baseline, max_regression):
+    """Return list of scenarios which are slower than in baseline by more than max_regression (fraction)"""
+    slower = []
+
+    for name, res in iteritems(report['scenarios']):
+        base = baseline.get('scenarios', {}).get(name, None)
+
+        if base and base['results_per_second'] and res['results_per_second']:
+            ratio = res['results_per_second'] / base['results_per_second']
+
+            if ratio < 1 - max_regression:
+                slower.append((name, ratio))
+
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of ludolph_ansible callbacks and output processing.')
+    parser.add_argument('--hosts', type=int, help='run only one scenario with this number of hosts')
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--items', type=int, default=0, help='loop items per task')
+    parser.add_argument('--changed', type=float, default=0.2, help='fraction of changed results')
+    parser.add_argument('--failed', type=float, default=0.01, help='fraction of failed results')
+    parser.add_argument('--unreachable', type=float, default=0.005, help='fraction of unreachable hosts')
+    parser.add_argument('--stdout-size', type=int, default=1024)
+    parser.add_argument('--output', choices=('full', 'failures', 'progress'), default='full')
+    parser.add_argument('--verbose', type=int, default=0, help='ansible verbosity')
+    parser.add_argument('--trace-memory', action='store_true', help='measure allocations with tracemalloc (slow)')
+    parser.add_argument('--json', action='store_true', help='print report as JSON')
+    parser.add_argument('--baseline', help='JSON report to compare with; exit with 1 on regression')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='allowed throughput drop (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    if args.hosts:
+        scenarios = (('custom', {'hosts': args.hosts, 'tasks': args.tasks, 'items': args.items,
+                                 'changed': args.changed, 'failed': args.failed, 'unreachable': args.unreachable,
+                                 'stdout_size': args.stdout_size, 'output': args.output}),)
+    else:
+        scenarios = SCENARIOS
+
+    report = {'scenarios': {}, 'micro': micro()}
+
+    for name, params in scenarios:
+        report['scenarios'][name] = res = run(verbose=args.verbose, trace_memory=args.trace_memory, **params)
+
+        if not args.json:
+            print('%-24s %8d results %8.2fs %10.0f results/s %6d messages %10d bytes%s' % (
+                name, res['results'], res['seconds'], res['results_per_second'] or 0, res['messages'],
+                res['message_bytes'],
+                '' if res['traced_peak_bytes'] is None else ' %10d peak traced bytes' % res['traced_peak_bytes']))
+
+    if args.json:
+        print(json.dumps(report, indent=4, sort_keys=True))
+    else:
+        for name, seconds in sorted(report['micro'].items()):
+            print('%-36s %8.2f us/call' % (name, seconds * 1000000))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = _compare(report, json.load(f), args.max_regression)
+
+        for name, ratio in slower:
+            print('REGRESSION: %s runs at %d%% of baseline throughput' % (name, ratio * 100), file=sys.stderr)
+
+        if slower:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import logging
+from threading import Event, Lock, Thread, local
+from collections import namedtuple, OrderedDict
+
+from .lazy import LazyModule
+
+logger = logging.getLogger(__name__)
+constants = LazyModule('ansible.constants')
+utils = LazyModule('ansible.utils')
+_recorder = local()
+
+TaskInfo = namedtuple('TaskInfo', ('name', 'tags', 'role'))
+PlayInfo = namedtuple('PlayInfo', ('name', 'tags', 'hosts', 'tasks'))
+
+
+def _record_parsed_files():
+    """Remember every YAML file parsed by ansible in the current thread"""
+    if getattr(utils, '_ludolph_recorded', False):
+        return
+
+    parse_yaml_from_file = utils.parse_yaml_from_file
+
+    def _parse_yaml_from_file(path, *args, **kwargs):
+        files = getattr(_recorder, 'files', None)
+
+        if files is not None:
+            files.add(path)
+
+        return parse_yaml_from_file(path, *args, **kwargs)
+
+    utils.parse_yaml_from_file = _parse_yaml_from_file
+    utils._ludolph_recorded = True
+
+
+def _stat(file_path):
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    else:
+        return st.st_mtime, st.st_size
+
+
+def snapshot(files):
+    """Return file -> (mtime, size) mapping; directories are included so that new files are noticed, too"""
+    paths = set(files)
+    paths.update(os.path.dirname(f) for f in files)
+
+    return dict((p, _stat(p)) for p in paths)
+
+
+class PlaybookInfo(object):
+    """
+    Plays and tasks of a parsed playbook together with all files used for parsing it.
+    """
+    def __init__(self, filename, plays, files):
+        self.filename = filename
+        self.plays = plays
+        self.files = snapshot(files)
+
+    def __repr__(self):
+        return '<PlaybookInfo: %s>' % self.filename
+
+    def is_valid(self):
+        return all(_stat(p) == st for p, st in self.files.items())
+
+    @classmethod
+    def load(cls, load_fun, pb_path):
+        """Parse playbook created by load_fun(pb_path) and collect its plays and tasks"""
+        from ansible.playbook.play import Play
+
+        _record_parsed_files()
+        _recorder.files = files = set([pb_path])
+
+        try:
+            pb = load_fun(pb_path)
+            plays = []
+
+            for play_ds, play_basedir in zip(pb.playbook, pb.play_basedirs):
+                play = Play(pb, play_ds, play_basedir)
+                tasks = tuple(TaskInfo(getattr(task, 'name', None), tuple(task.tags), task.role_name)
+                              for task in pb.tasks_to_run_in_play(play))
+                plays.append(PlayInfo(play.name, tuple(play.tags), play.hosts, tasks))
+        finally:
+            _recorder.files = None
+
+        return cls(pb.filename, tuple(plays), files)
+
+
+class PlaybookCache(object):
+    """
+    Bounded LRU cache of parsed playbooks. Entries are reloaded when any of the parsed files changes.
+    """
+    def __init__(self, load_fun, size=32):
+        self.load_fun = load_fun
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, pb_path):
+        with self._lock:
+            info = self._cache.pop(pb_path, None)
+
+        if info is None or not info.is_valid():
+            info = PlaybookInfo.load(self.load_fun, pb_path)
+
+        with self._lock:
+            self._cache[pb_path] = info
+
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+        return info
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class InventoryCache(object):
+    """
+    Parsed inventory which is reloaded when its files change. Results of host pattern and subset resolution are
+    cached until the inventory changes. Dynamic inventory scripts are parsed again for every request.
+    The inventory is parsed on first use; without host_list the ansible default inventory is used.
+    """
+    def __init__(self, host_list=None):
+        self._host_list = host_list
+        self._dynamic = None
+        self._inventory = None
+        self._files = None
+        self._hosts = {}  # (pattern, subset) -> host names
+        self._lock = Lock()
+        self._stop = Event()
+
+    @property
+    def host_list(self):
+        if self._host_list is None:
+            self._host_list = constants.DEFAULT_HOST_LIST
+
+        return self._host_list
+
+    @property
+    def dynamic(self):
+        if self._dynamic is None:
+            self._dynamic = self._is_dynamic(self.host_list)
+
+        return self._dynamic
+
+    @staticmethod
+    def _is_dynamic(host_list):
+        if os.path.isdir(host_list):
+            files = [os.path.join(host_list, f) for f in os.listdir(host_list)]
+        else:
+            files = [host_list]
+
+        return any(os.path.isfile(f) and utils.is_executable(f) for f in files)
+
+    def _source_files(self):
+        """Inventory files together with group_vars and host_vars files"""
+        files = []
+
+        if os.path.isdir(self.host_list):
+            basedir = self.host_list
+            files.extend(os.path.join(basedir, f) for f in os.listdir(basedir))
+        else:
+            basedir = os.path.dirname(self.host_list)
+            files.append(self.host_list)
+
+        for vars_dir in ('group_vars', 'host_vars'):
+            for root, dirs, dir_files in os.walk(os.path.join(basedir, vars_dir)):
+                files.append(root)
+                files.extend(os.path.join(root, f) for f in dir_files)
+
+        return files
+
+    def new(self):
+        """Return new inventory object, e.g. for a playbook run which restricts and subsets its inventory"""
+        from ansible.inventory import Inventory
+
+        return Inventory(self.host_list)
+
+    def is_valid(self):
+        files = self._files
+
+        return files is not None and all(_stat(p) == st for p, st in files.items())
+
+    def reload(self):
+        files = snapshot(self._source_files())
+        inventory = self.new()
+
+        with self._lock:
+            self._inventory = inventory
+            self._files = files
+            self._hosts = {}
+
+        return inventory
+
+    def get(self):
+        """Return current inventory object"""
+        if self.dynamic:
+            return self.new()
+
+        if not self.is_valid():
+            return self.reload()
+
+        return self._inventory
+
+    def list_hosts(self, pattern='all', subset=None):
+        """Return list of host names matching pattern and subset"""
+        inventory = self.get()
+        key = (pattern, subset)
+
+        with self._lock:
+            hosts = self._hosts.get(key, None) if inventory is self._inventory else None
+
+            if hosts is None:
+                inventory.subset(subset)
+
+                try:
+                    hosts = tuple(inventory.list_hosts(pattern))
+                finally:
+                    inventory.subset(None)
+
+                if inventory is self._inventory:
+                    self._hosts[key] = hosts
+
+        return list(hosts)
+
+    def _watch(self, interval):
+        if self.dynamic:
+            return
+
+        while not self._stop.wait(interval):
+            try:
+                if not self.is_valid():
+                    logger.info('Reloading inventory "%s"', self.host_list)
+                    self.reload()
+            except Exception as exc:
+                logger.error('Could not reload inventory "%s": %s', self.host_list, exc)
+
+    def watch(self, interval):
+        """Reload changed inventory in background every interval seconds"""
+        if interval <= 0:
+            return
+
+        thread = Thread(target=self._watch, args=(interval,), name='ludolph_ansible-inventory')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
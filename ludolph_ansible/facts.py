@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import logging
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from ansible.playbook import PlayBook
+
+logger = logging.getLogger(__name__)
+
+
+class FactStore(object):
+    """
+    Facts of every host saved in a JSON file. Files older than ttl seconds are ignored.
+    """
+    def __init__(self, cache_dir, ttl=3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def path(self, host):
+        return os.path.join(self.cache_dir, '%s.json' % host.replace(os.sep, '_'))
+
+    def age(self, host):
+        """Return age of saved facts in seconds or None"""
+        try:
+            return time.time() - os.stat(self.path(host)).st_mtime
+        except OSError:
+            return None
+
+    def load(self, host):
+        """Return facts of a host or None if they are missing or expired"""
+        age = self.age(host)
+
+        if age is None or age > self.ttl:
+            return None
+
+        try:
+            with open(self.path(host)) as f:
+                return json.load(f)
+        except (IOError, ValueError) as exc:
+            logger.error('Could not load cached facts of host "%s": %s', host, exc)
+            return None
+
+    def save(self, host, facts):
+        file_path = self.path(host)
+        tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(facts, f, default=str)
+
+            os.rename(tmp_path, file_path)
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            logger.error('Could not save cached facts of host "%s": %s', host, exc)
+
+
+class RunFacts(MutableMapping):
+    """
+    Setup cache of one playbook run, which loads facts from a FactStore on first use. Facts gathered by the setup
+    module are saved into the store by save().
+    """
+    def __init__(self, store, refresh=False):
+        self.store = store
+        self.refresh = refresh  # Do not use saved facts
+        self._facts = {}
+        self._gathered = set()
+
+    def _load(self, host):
+        if host not in self._facts and not self.refresh:
+            facts = self.store.load(host)
+
+            if facts is not None:
+                self._facts[host] = facts
+
+    def __getitem__(self, host):
+        self._load(host)
+
+        return self._facts[host]
+
+    def __contains__(self, host):
+        self._load(host)
+
+        return host in self._facts
+
+    def __setitem__(self, host, facts):
+        self._facts[host] = facts
+
+        if 'module_setup' in facts:
+            self._gathered.add(host)
+
+    def __delitem__(self, host):
+        del self._facts[host]
+        self._gathered.discard(host)
+
+    def __iter__(self):
+        return iter(self._facts)
+
+    def __len__(self):
+        return len(self._facts)
+
+    def copy(self):
+        """Return plain dict of loaded facts (used by the ansible runner for hostvars)"""
+        return dict(self._facts)
+
+    def is_cached(self, host):
+        """True if the host has facts gathered by the setup module"""
+        return host in self and 'module_setup' in self[host]
+
+    def save(self):
+        for host in self._gathered:
+            self.store.save(host, self._facts[host])
+
+        self._gathered.clear()
+
+
+class CachedFactsPlayBook(PlayBook):
+    """
+    Playbook which gathers facts only for hosts without cached facts.
+    """
+    def __init__(self, fact_store=None, refresh_facts=False, **kwargs):
+        super(CachedFactsPlayBook, self).__init__(**kwargs)
+        self.SETUP_CACHE = RunFacts(fact_store, refresh=refresh_facts)
+
+    def _do_setup_step(self, play):
+        play_hosts = play._play_hosts
+        hosts = [host for host in play_hosts if not self.SETUP_CACHE.is_cached(host)]
+
+        if not hosts:
+            return {}
+
+        play._play_hosts = hosts
+
+        try:
+            return super(CachedFactsPlayBook, self)._do_setup_step(play)
+        finally:
+            play._play_hosts = play_hosts
+
+    def run(self):
+        try:
+            return super(CachedFactsPlayBook, self).run()
+        finally:
+            self.SETUP_CACHE.save()
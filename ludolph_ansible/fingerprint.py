@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+from threading import Lock
+
+VARS_DIRS = ('group_vars', 'host_vars')
+VARS_EXTENSIONS = ('.yml', '.yaml', '.json')  # Variables of a host or group can be in <name> or <name>.<ext>
+
+
+def _role_dirs(files):
+    """Return directories of roles used by a playbook (parsed files of a role are in <dir>/roles/<role>/...)"""
+    dirs = set()
+
+    for file_path in files:
+        parts = file_path.split(os.sep)
+
+        for i in range(len(parts) - 2, 0, -1):
+            if parts[i] == 'roles':
+                dirs.add(os.sep.join(parts[:i + 2]))
+                break
+
+    return dirs
+
+
+def _vars_owner(file_path):
+    """Return ('host_vars', host) or ('group_vars', group) for a file in a host_vars or group_vars directory"""
+    parts = file_path.split(os.sep)
+
+    for i in range(len(parts) - 2, -1, -1):
+        if parts[i] in VARS_DIRS:
+            name = parts[i + 1]
+            base, ext = os.path.splitext(name)
+
+            if ext in VARS_EXTENSIONS:
+                name = base
+
+            return parts[i], name
+
+    return None
+
+
+def vars_files(files):
+    """Return (vars owner, file) pairs of parsed host_vars and group_vars files (see _vars_owner())"""
+    res = []
+
+    for file_path in sorted(files):
+        owner = _vars_owner(file_path)
+
+        if owner is not None and os.path.isfile(file_path):
+            res.append((owner, file_path))
+
+    return res
+
+
+def playbook_files(files):
+    """
+    Return sorted list of parsed playbook files together with all files of used roles (templates, files, ...).
+    Host and group variables are left out, because they affect only some hosts (see vars_files()).
+    """
+    res = set(f for f in files if os.path.isfile(f) and _vars_owner(f) is None)
+
+    for role_dir in _role_dirs(res):
+        for root, dirs, dir_files in os.walk(role_dir):
+            res.update(os.path.join(root, f) for f in dir_files)
+
+    return sorted(res)
+
+
+class FileDigests(object):
+    """
+    Digests of file contents cached by file path. A file is read again only when its mtime or size changes, so
+    unchanged role files (e.g. large files/ trees) are not hashed at the start of every run.
+    """
+    def __init__(self):
+        self._cache = {}  # file path -> ((mtime, size), digest)
+        self._lock = Lock()
+
+    def get(self, file_path):
+        """Return hex digest of file contents or None if the file cannot be read"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+
+        key = (st.st_mtime, st.st_size)
+
+        with self._lock:
+            cached = self._cache.get(file_path, None)
+
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.sha1()
+
+        try:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+        except (IOError, OSError):
+            return None
+
+        with self._lock:
+            self._cache[file_path] = (key, digest.hexdigest())
+
+        return digest.hexdigest()
+
+
+def hash_files(files, digests):
+    """Return hash of names and contents of files; digests of contents are taken from a FileDigests cache"""
+    digest = hashlib.sha1()
+
+    for file_path in files:
+        digest.update(file_path.encode('utf-8'))
+        digest.update((digests.get(file_path) or '\0').encode('ascii'))
+
+    return digest.hexdigest()
+
+
+def _host_vars_owners(inventory, host):
+    owners = [('host_vars', host)]
+    host_obj = inventory.get_host(host)
+
+    if host_obj is not None:
+        owners.extend(('group_vars', group.name) for group in host_obj.get_groups())
+
+    return frozenset(owners)
+
+
+def host_fingerprints(files_hash, tags, inventory, hosts, host_vars_files=(), digests=None):
+    """
+    Return host -> hash of playbook files, tags, host and group variables and contents of parsed host_vars and
+    group_vars files of the host (host_vars_files are pairs returned by vars_files())
+    """
+    res = {}
+
+    if digests is None:
+        digests = FileDigests()
+
+    for host in hosts:
+        digest = hashlib.sha1()
+        digest.update(('%s\0%s\0' % (files_hash, tags)).encode('utf-8'))
+        digest.update(json.dumps(inventory.get_variables(host), sort_keys=True, default=str).encode('utf-8'))
+
+        if host_vars_files:
+            owners = _host_vars_owners(inventory, host)
+            digest.update(hash_files([f for owner, f in host_vars_files if owner in owners], digests).encode('ascii'))
+
+        res[host] = digest.hexdigest()
+
+    return res
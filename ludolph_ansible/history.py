@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import sqlite3
+from contextlib import closing
+from collections import namedtuple
+
+from six import binary_type, iteritems
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS runs ('
+    '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    '  playbook TEXT NOT NULL,'
+    '  owner TEXT,'
+    '  state TEXT NOT NULL,'
+    '  started REAL NOT NULL,'
+    '  duration REAL,'
+    '  tags TEXT,'
+    '  subset TEXT,'
+    '  check_mode INTEGER NOT NULL DEFAULT 0,'
+    '  hosts INTEGER NOT NULL DEFAULT 0,'
+    '  changed_hosts INTEGER NOT NULL DEFAULT 0,'
+    '  failed_hosts INTEGER NOT NULL DEFAULT 0,'
+    '  failed_task TEXT,'
+    '  mode TEXT,'
+    '  forks INTEGER,'
+    '  shards INTEGER'
+    ')',
+    'CREATE INDEX IF NOT EXISTS runs_playbook_started ON runs (playbook, started)',
+    'CREATE INDEX IF NOT EXISTS runs_started ON runs (started)',
+    'CREATE TABLE IF NOT EXISTS host_results ('
+    '  run_id INTEGER NOT NULL REFERENCES runs (id),'
+    '  host TEXT NOT NULL,'
+    '  ok INTEGER NOT NULL,'
+    '  changed INTEGER NOT NULL,'
+    '  unreachable INTEGER NOT NULL,'
+    '  failures INTEGER NOT NULL,'
+    '  skipped INTEGER NOT NULL,'
+    '  duration REAL'
+    ')',
+    'CREATE INDEX IF NOT EXISTS host_results_host_run ON host_results (host, run_id)',
+    'CREATE INDEX IF NOT EXISTS host_results_run ON host_results (run_id)',
+    'CREATE TABLE IF NOT EXISTS task_times ('
+    '  run_id INTEGER NOT NULL REFERENCES runs (id),'
+    '  play TEXT,'
+    '  task TEXT NOT NULL,'
+    '  duration REAL NOT NULL,'
+    '  hosts INTEGER NOT NULL,'
+    '  slowest_host TEXT,'
+    '  slowest_host_duration REAL'
+    ')',
+    'CREATE INDEX IF NOT EXISTS task_times_run ON task_times (run_id)',
+    'CREATE TABLE IF NOT EXISTS host_fingerprints ('
+    '  playbook TEXT NOT NULL,'
+    '  host TEXT NOT NULL,'
+    '  fingerprint TEXT NOT NULL,'
+    '  converged INTEGER NOT NULL,'
+    '  updated REAL NOT NULL,'
+    '  PRIMARY KEY (playbook, host)'
+    ')',
+)
+
+# Columns added to existing tables of databases created by older versions
+MIGRATIONS = (
+    ('runs', 'failed_task', 'ALTER TABLE runs ADD COLUMN failed_task TEXT'),
+    ('runs', 'mode', 'ALTER TABLE runs ADD COLUMN mode TEXT'),
+    ('runs', 'forks', 'ALTER TABLE runs ADD COLUMN forks INTEGER'),
+    ('runs', 'shards', 'ALTER TABLE runs ADD COLUMN shards INTEGER'),
+)
+
+Run = namedtuple('Run', ('id', 'playbook', 'owner', 'state', 'started', 'duration', 'tags', 'subset', 'check_mode',
+                         'hosts', 'changed_hosts', 'failed_hosts'))
+HostRun = namedtuple('HostRun', ('run_id', 'playbook', 'started', 'state', 'ok', 'changed', 'unreachable', 'failures',
+                                 'skipped', 'duration'))
+
+
+def _text(value):
+    """SQLite on Python 2 refuses non-ASCII byte strings (e.g. task names converted by ansible's to_bytes)"""
+    if isinstance(value, binary_type):
+        return value.decode('utf-8', 'replace')
+    else:
+        return value
+
+
+class RunHistory(object):
+    """
+    Playbook runs stored in a local SQLite database.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+
+        with closing(self._connect()) as db:
+            with db:
+                for sql in SCHEMA:
+                    db.execute(sql)
+
+                for table, column, sql in MIGRATIONS:
+                    if column not in [row[1] for row in db.execute('PRAGMA table_info(%s)' % table)]:
+                        db.execute(sql)
+
+    def _connect(self):
+        # Every call opens a new connection, because SQLite connections cannot be shared between threads
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def add(self, playbook, owner, state, started, duration, stats, timer=None, tags=None, subset=None,
+            check=False, mode=None, forks=None, shards=1):
+        """Save one playbook run together with per-host results and task times; return run ID"""
+        host_times = timer.hosts if timer is not None else {}
+        failed_task = _text(stats.failed_task[1]) if stats.failed_task is not None else None
+        hosts = []
+        changed_hosts = failed_hosts = 0
+
+        for host, host_stats in iteritems(stats.processed):
+            hosts.append((host_stats.ok, host_stats.changed, host_stats.dark, host_stats.failures,
+                          host_stats.skipped, host_times.get(host, None), _text(host)))
+
+            if host_stats.changed:
+                changed_hosts += 1
+
+            if host_stats.failures or host_stats.dark:
+                failed_hosts += 1
+
+        with closing(self._connect()) as db:
+            with db:
+                run_id = db.execute(
+                    'INSERT INTO runs (playbook, owner, state, started, duration, tags, subset, check_mode, hosts, '
+                    'changed_hosts, failed_hosts, failed_task, mode, forks, shards) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (playbook, owner, state, started, duration, tags, subset, int(bool(check)), len(hosts),
+                     changed_hosts, failed_hosts, failed_task, mode, forks, shards)
+                ).lastrowid
+                db.executemany('INSERT INTO host_results (run_id, ok, changed, unreachable, failures, skipped, '
+                               'duration, host) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', ((run_id,) + h for h in hosts))
+
+                if timer is not None:
+                    db.executemany('INSERT INTO task_times (run_id, play, task, duration, hosts, slowest_host, '
+                                   'slowest_host_duration) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   ((run_id, _text(t.play), _text(t.name), t.duration, t.hosts,
+                                     _text(t.slowest_host), t.slowest_host_duration) for t in timer.tasks))
+
+        return run_id
+
+    def runs(self, playbook, count=10):
+        """Return latest runs of a playbook"""
+        with closing(self._connect()) as db:
+            return [Run(*row) for row in db.execute(
+                'SELECT id, playbook, owner, state, started, duration, tags, subset, check_mode, hosts, '
+                'changed_hosts, failed_hosts FROM runs WHERE playbook = ? ORDER BY started DESC LIMIT ?',
+                (playbook, count)
+            )]
+
+    def failing_hosts(self, playbook, runs=10, count=10):
+        """Return (host, number of runs) pairs of hosts which failed or were unreachable in latest runs"""
+        with closing(self._connect()) as db:
+            return db.execute(
+                'SELECT h.host, COUNT(*) AS failed_runs FROM host_results h '
+                'JOIN (SELECT id FROM runs WHERE playbook = ? ORDER BY started DESC LIMIT ?) r ON h.run_id = r.id '
+                'WHERE h.failures > 0 OR h.unreachable > 0 '
+                'GROUP BY h.host ORDER BY failed_runs DESC, h.host LIMIT ?',
+                (playbook, runs, count)
+            ).fetchall()
+
+    @staticmethod
+    def _last_run(db, playbook):
+        """Return (id, failed_task) of the latest run which was not cancelled and was not a check of mode=plan-apply"""
+        return db.execute(
+            'SELECT id, failed_task FROM runs WHERE playbook = ? AND state != ? AND (mode IS NULL OR mode != ?) '
+            'ORDER BY started DESC LIMIT 1',
+            (playbook, 'cancelled', 'plan-apply')
+        ).fetchone()
+
+    def last_failed_hosts(self, playbook):
+        """Return list of hosts which failed or were unreachable in the latest finished run or None if there is none"""
+        with closing(self._connect()) as db:
+            run = self._last_run(db, playbook)
+
+            if run is None:
+                return None
+
+            return [row[0] for row in db.execute(
+                'SELECT host FROM host_results WHERE run_id = ? AND (failures > 0 OR unreachable > 0) ORDER BY host',
+                (run[0],)
+            )]
+
+    def last_failed_task(self, playbook):
+        """Return name of the first task which failed in the latest finished run or None"""
+        with closing(self._connect()) as db:
+            run = self._last_run(db, playbook)
+
+        if run is None:
+            return None
+
+        return run[1]
+
+    def save_fingerprints(self, playbook, fingerprints, stats, updated):
+        """Save input fingerprints of hosts processed by a run and whether the run changed or failed anything"""
+        rows = []
+
+        for host, host_stats in iteritems(stats.processed):
+            fingerprint = fingerprints.get(host, None)
+
+            if fingerprint is not None:
+                converged = not (host_stats.changed or host_stats.failures or host_stats.dark)
+                rows.append((playbook, host, fingerprint, int(converged), updated))
+
+        with closing(self._connect()) as db:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO host_fingerprints (playbook, host, fingerprint, converged, '
+                               'updated) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def converged_hosts(self, playbook, fingerprints):
+        """Return set of hosts whose last run was fully ok without changes and whose fingerprint did not change"""
+        with closing(self._connect()) as db:
+            return set(host for host, fingerprint in db.execute(
+                'SELECT host, fingerprint FROM host_fingerprints WHERE playbook = ? AND converged = 1', (playbook,)
+            ) if fingerprints.get(host, None) == fingerprint)
+
+    def task_times(self, playbook, runs=10):
+        """
+        Return (number of runs, (play, task) -> [(duration, hosts, slowest host time, forks, shards)]) of latest
+        finished runs; forks and shards are None for runs saved by older versions
+        """
+        res = {}
+        run_ids = set()
+
+        with closing(self._connect()) as db:
+            for run_id, play, task, duration, hosts, slowest, forks, shards in db.execute(
+                'SELECT t.run_id, t.play, t.task, t.duration, t.hosts, t.slowest_host_duration, r.forks, r.shards '
+                'FROM task_times t JOIN (SELECT id, forks, shards FROM runs WHERE playbook = ? AND state = ? '
+                'AND check_mode = 0 ORDER BY started DESC LIMIT ?) r ON t.run_id = r.id',
+                (playbook, 'finished', runs)
+            ):
+                run_ids.add(run_id)
+                res.setdefault((play, task), []).append((duration, hosts, slowest or 0.0, forks, shards))
+
+        return len(run_ids), res
+
+    def host_runs(self, host, count=10):
+        """Return latest results of one host"""
+        with closing(self._connect()) as db:
+            return [HostRun(*row) for row in db.execute(
+                'SELECT h.run_id, r.playbook, r.started, r.state, h.ok, h.changed, h.unreachable, h.failures, '
+                'h.skipped, h.duration FROM host_results h JOIN runs r ON r.id = h.run_id '
+                'WHERE h.host = ? ORDER BY h.run_id DESC LIMIT ?',
+                (host, count)
+            )]
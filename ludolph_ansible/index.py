@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import logging
+from fnmatch import fnmatch
+from threading import Lock
+
+from six import iteritems
+
+logger = logging.getLogger(__name__)
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+class PlaybookIndex(object):
+    """
+    Inverted index of tags, task names and roles of all configured playbooks.
+    """
+    KINDS = ('tag', 'task', 'role')
+
+    def __init__(self, cache, playbooks):
+        self.cache = cache
+        self.playbooks = playbooks  # Playbook alias -> playbook file path
+        self._infos = {}  # Playbook alias -> indexed PlaybookInfo
+        self._entries = {}  # Playbook alias -> list of (kind, value, play number)
+        self._index = dict((kind, {}) for kind in self.KINDS)  # kind -> value -> set of (alias, play number)
+        self._lock = Lock()
+        self._refresh_lock = Lock()
+
+    def _remove(self, alias):
+        for kind, value, play_no in self._entries.pop(alias, ()):
+            postings = self._index[kind][value]
+            postings.discard((alias, play_no))
+
+            if not postings:
+                del self._index[kind][value]
+
+    def _add(self, alias, info):
+        entries = self._entries[alias] = []
+
+        for play_no, play in enumerate(info.plays, start=1):
+            values = set(('tag', tag) for tag in play.tags)
+
+            for task in play.tasks:
+                values.update(('tag', tag) for tag in task.tags if tag != 'untagged')
+
+                if task.name is not None:  # meta tasks have no names
+                    values.add(('task', task.name))
+
+                if task.role:
+                    values.add(('role', task.role))
+
+            for kind, value in values:
+                self._index[kind].setdefault(value, set()).add((alias, play_no))
+                entries.append((kind, value, play_no))
+
+    def refresh(self):
+        """Index new playbooks and re-index playbooks whose files have changed"""
+        with self._refresh_lock:
+            for alias, pb_path in iteritems(self.playbooks):
+                info = self._infos.get(alias, None)
+
+                if info is not None and info.is_valid():
+                    continue
+
+                try:
+                    info = self.cache.get(pb_path)
+                except Exception as exc:
+                    logger.error('Could not index playbook "%s": %s', pb_path, exc)
+                    info = None
+
+                with self._lock:
+                    self._remove(alias)
+
+                    if info is None:
+                        self._infos.pop(alias, None)
+                    else:
+                        self._infos[alias] = info
+                        self._add(alias, info)
+
+    def find(self, pattern, kinds=KINDS):
+        """Return sorted list of (kind, value, playbook alias, play number) tuples matching a glob pattern"""
+        res = []
+
+        with self._lock:
+            for kind in kinds:
+                index = self._index[kind]
+
+                if _is_glob(pattern):
+                    values = [value for value in index if fnmatch(value, pattern)]
+                elif pattern in index:
+                    values = [pattern]
+                else:
+                    values = []
+
+                for value in values:
+                    res.extend((kind, value, alias, play_no) for alias, play_no in index[value])
+
+        return sorted(res)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import time
+import logging
+from itertools import count
+from threading import Condition, Lock, Thread
+from multiprocessing import Event
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """raised inside a running job after it was cancelled"""
+    pass
+
+
+class JobQueueFull(Exception):
+    """raised when the job queue has no free slots"""
+    pass
+
+
+class OwnerQueueFull(JobQueueFull):
+    """raised when the job queue has no free slots for the owner of a job"""
+    pass
+
+
+class Job(object):
+    """
+    Playbook run executed in the background by a JobManager worker.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    id = None
+
+    def __init__(self, name, owner, fun=None, stats=None, options=None):
+        self.name = name
+        self.owner = owner
+        self.fun = fun  # Called with the job object as the only argument
+        self.stats = stats
+        self.hosts = None  # Frozen set of hosts used by the job; None means all hosts
+        self.priority = 0  # Pending jobs with higher priority are started first
+        self.options = options or {}  # apb command options
+        self.run_key = None  # Identical apb commands are attached to a pending or running job with the same run key
+        self.recipients = []  # Messages which receive job output
+        self.plan = None  # Hosts with pending changes found by a mode=plan-apply job waiting for apb-apply
+        self.fingerprints = None  # Host -> fingerprint of playbook inputs (used by skip_converged)
+        self.state = self.PENDING
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel_event = Event()  # Also visible in processes forked for playbook shards
+
+    def __repr__(self):
+        return '<Job %s: %s [%s]>' % (self.id, self.name, self.state)
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def done(self):
+        return self.state in (self.FINISHED, self.FAILED, self.CANCELLED)
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+
+        return (self.finished or time.time()) - self.started
+
+    def cancel(self):
+        """Request job cancellation; a running job is stopped by the next check_cancelled() call"""
+        self._cancel_event.set()
+
+        if self.state == self.PENDING:
+            self.state = self.CANCELLED
+            self.finished = time.time()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled('Job %s was cancelled' % self.id)
+
+    def run(self):
+        if self.cancelled:
+            return
+
+        self.state = self.RUNNING
+        self.started = time.time()
+
+        try:
+            self.fun(self)
+        except JobCancelled:
+            self.state = self.CANCELLED
+        except Exception as exc:
+            logger.exception(exc)
+            self.error = exc
+            self.state = self.FAILED
+        else:
+            self.state = self.FINISHED
+        finally:
+            self.finished = time.time()
+
+
+class JobManager(object):
+    """
+    Bounded pool of worker threads running submitted jobs.
+
+    Pending jobs are ordered by priority, then by the number of running jobs of their owners (fair share) and then by
+    submission time. Every owner can have at most owner_workers running and owner_queue_size pending jobs (0 means
+    unlimited).
+
+    Jobs with a host set (job.hosts) run in parallel only when their host sets do not overlap; a job without hosts
+    conflicts with every other job. A pending job is started as soon as its hosts are free, unless one of them is
+    also needed by a pending job before it in the queue, which keeps the order of conflicting jobs.
+    """
+    def __init__(self, workers=2, queue_size=0, keep_done=50, first_id=1, owner_workers=0, owner_queue_size=0):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.owner_workers = owner_workers
+        self.owner_queue_size = owner_queue_size
+        self.keep_done = keep_done
+        self._jobs = OrderedDict()
+        self._ids = count(first_id)
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._pending = []
+        self._running = []
+        self._threads = []
+        self._stopped = False
+
+    def _start_workers(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = Thread(target=self._worker, name='ludolph_ansible-job-worker-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def _conflicts(job1, job2):
+        return job1.hosts is None or job2.hosts is None or not job1.hosts.isdisjoint(job2.hosts)
+
+    def _queue(self):
+        """Return pending jobs in the order in which they should start; called with the lock held"""
+        self._pending = [job for job in self._pending if not job.done]
+        running = Counter(job.owner for job in self._running)
+
+        return sorted(self._pending, key=lambda job: (-job.priority, running[job.owner], job.id))
+
+    def _next_job(self):
+        """Remove and return first pending job which can run now; called with the lock held"""
+        queue = self._queue()
+        running = Counter(job.owner for job in self._running)
+        busy_hosts = set()
+        waiting = False  # A pending job before the current one is waiting for its hosts
+
+        for job in self._running:
+            if job.hosts is None:
+                return None
+
+            busy_hosts.update(job.hosts)
+
+        for job in queue:
+            if self.owner_workers and running[job.owner] >= self.owner_workers:
+                continue  # The job does not reserve its hosts while its owner is at the limit
+
+            if job.hosts is None:
+                if not waiting and not self._running:
+                    self._pending.remove(job)
+                    return job
+
+                return None
+
+            if job.hosts.isdisjoint(busy_hosts):
+                self._pending.remove(job)
+                return job
+
+            busy_hosts.update(job.hosts)  # Hosts reserved for a pending job before the next ones
+            waiting = True
+
+        return None
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                job = None
+
+                while not self._stopped:
+                    job = self._next_job()
+
+                    if job is not None:
+                        break
+
+                    self._changed.wait()
+
+                if job is None:
+                    break
+
+                self._running.append(job)
+
+            try:
+                job.run()
+            finally:
+                with self._lock:
+                    self._running.remove(job)
+                    self._changed.notify_all()
+
+            self._cleanup()
+
+    def _cleanup(self):
+        """Forget oldest finished jobs"""
+        with self._lock:
+            done = [job_id for job_id, job in self._jobs.items() if job.done]
+
+            for job_id in done[:max(len(done) - self.keep_done, 0)]:
+                del self._jobs[job_id]
+
+    def submit(self, job):
+        """Assign job ID and put the job into the queue"""
+        with self._lock:
+            pending = [j for j in self._pending if not j.done]
+
+            if self.queue_size and len(pending) >= self.queue_size:
+                raise JobQueueFull('Job queue is full')
+
+            if self.owner_queue_size and len([j for j in pending if j.owner == job.owner]) >= self.owner_queue_size:
+                raise OwnerQueueFull('Job queue is full for %s' % job.owner)
+
+            self._start_workers()
+            job.id = next(self._ids)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._changed.notify_all()
+
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id, None)
+
+    def all(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def position(self, job):
+        """Return position of a pending job in the queue (starting with 1) or None"""
+        with self._lock:
+            try:
+                return self._queue().index(job) + 1
+            except ValueError:
+                return None
+
+    def waiting_for(self, job):
+        """Return running jobs which block a pending job"""
+        with self._lock:
+            return [j for j in self._running if j is not job and self._conflicts(job, j)]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+
+        if job is not None:
+            job.cancel()
+
+            with self._lock:
+                self._changed.notify_all()  # A cancelled pending job does not block other jobs anymore
+
+        return job
+
+    def shutdown(self):
+        """Cancel all jobs and stop workers"""
+        for job in self.all():
+            job.cancel()
+
+        with self._lock:
+            self._stopped = True
+            del self._pending[:]
+            self._changed.notify_all()
+
+        del self._threads[:]
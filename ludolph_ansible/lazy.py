@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+from importlib import import_module
+
+
+class LazyModule(object):
+    """
+    Module proxy which imports the module (and its submodules) on first attribute access. Importing ansible is slow,
+    so the plugin imports it only when it is needed for the first time.
+    """
+    def __init__(self, name, *submodules):
+        self.__dict__['_names'] = (name,) + submodules
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+
+        if module is None:
+            names = self.__dict__['_names']
+
+            for name in reversed(names):
+                module = import_module(name)
+
+            self.__dict__['_module'] = module
+
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<LazyModule: %s>' % self.__dict__['_names'][0]
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import logging
+from bisect import bisect_left
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value):
+    return ('%s' % value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else '%d' % value
+
+
+class Metrics(object):
+    """
+    Counters and histograms exported in the Prometheus text format. Every metric has to be registered before use.
+    """
+    def __init__(self, prefix='ludolph_ansible_'):
+        self.prefix = prefix
+        self._lock = Lock()
+        self._metrics = []  # list of (name, type, help, buckets)
+        self._values = {}  # name -> {sorted labels: value or [bucket counts, sum, count]}
+        self._buckets = {}  # histogram name -> upper bounds of buckets
+
+    def counter(self, name, doc):
+        self._metrics.append((self.prefix + name, 'counter', doc, None))
+        self._values[self.prefix + name] = {}
+
+    def histogram(self, name, doc, buckets=DURATION_BUCKETS):
+        buckets = self._buckets[self.prefix + name] = tuple(buckets) + (float('inf'),)
+        self._metrics.append((self.prefix + name, 'histogram', doc, buckets))
+        self._values[self.prefix + name] = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increase counter"""
+        key = tuple(sorted(labels.items()))
+        values = self._values[self.prefix + name]
+
+        with self._lock:
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add value to a histogram"""
+        key = tuple(sorted(labels.items()))
+        values = self._values[self.prefix + name]
+        buckets = self._buckets[self.prefix + name]
+
+        with self._lock:
+            try:
+                hist = values[key]
+            except KeyError:
+                hist = values[key] = [[0] * len(buckets), 0.0, 0]
+
+            hist[0][bisect_left(buckets, value)] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render(self, gauges=()):
+        """Return all metrics in the Prometheus text format; gauges is a list of (name, help, [(labels, value)])"""
+        res = []
+
+        with self._lock:
+            for name, metric_type, doc, buckets in self._metrics:
+                res.append('# HELP %s %s' % (name, doc))
+                res.append('# TYPE %s %s' % (name, metric_type))
+
+                for labels, value in sorted(self._values[name].items()):
+                    if metric_type == 'counter':
+                        res.append('%s%s %s' % (name, _labels(labels), _number(value)))
+                        continue
+
+                    counts, total, count = value
+                    cumulative = 0
+
+                    for le, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        res.append('%s_bucket%s %d' % (name, _labels(labels, (('le', _number(le)),)), cumulative))
+
+                    res.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+                    res.append('%s_count%s %d' % (name, _labels(labels), count))
+
+        for name, doc, values in gauges:
+            name = self.prefix + name
+            res.append('# HELP %s %s' % (name, doc))
+            res.append('# TYPE %s gauge' % name)
+
+            for labels, value in values:
+                res.append('%s%s %s' % (name, _labels(sorted(labels.items())), _number(value)))
+
+        res.append('')
+
+        return '\n'.join(res)
+
+    def write(self, file_path, gauges=()):
+        """Atomically write metrics into a file (for the node_exporter textfile collector)"""
+        tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render(gauges=gauges))
+
+            os.rename(tmp_path, file_path)
+        except (IOError, OSError) as exc:
+            logger.error('Could not write metrics into "%s": %s', file_path, exc)
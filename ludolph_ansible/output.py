@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import logging
+from collections import deque
+from threading import Lock, Thread
+from multiprocessing import Queue
+
+from six import binary_type, text_type
+from six.moves.queue import Empty
+
+logger = logging.getLogger(__name__)
+
+
+def _text(text):
+    """Task banners are byte strings and event lines can be unicode; they must not be mixed in one message"""
+    if isinstance(text, binary_type):
+        return text.decode('utf-8', 'replace')
+    else:
+        return text
+
+
+def _char_start(data, i):
+    """Return the nearest offset <= i which is not inside of an UTF-8 encoded character"""
+    while i > 0 and (bytearray(data[i:i + 1])[0] & 0xC0) == 0x80:
+        i -= 1
+
+    return i
+
+
+def _render(text, color=None):
+    return (text,)
+
+
+class OutputChannel(object):
+    """
+    Per-run output sink which coalesces lines into as few messages as possible.
+
+    Runner callbacks are called in forked ansible workers, so all lines travel through a multiprocessing queue to
+    a sender thread in the parent process; this also keeps their order.
+
+    Lines are written as (text, color) pairs, where text can also be an event object which is converted to text only
+    when needed. The sender thread writes the plain text into the optional log file and keeps at most buffer_size
+    pending lines. Pending lines are sent when the buffer is full or when the oldest one is older than interval
+    seconds; only then they are passed to render(text, color), which creates lines for chat and can leave some out.
+    Lines returned by the optional render.flush(last) method are added after each batch; last is True for the final one.
+    Rendered lines are sent in messages of at most max_size bytes.
+    """
+    def __init__(self, send_fun, max_size=16384, interval=2.0, render=_render, buffer_size=1000):
+        self.send_fun = send_fun
+        self.max_size = max_size
+        self.interval = interval
+        self.render = render
+        self.buffer_size = buffer_size
+        self.log = None  # Binary file receiving all lines; must be set before the first write
+        self.wrap_send = None  # Called with the method rendering and sending pending lines (used for profiling)
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._sender, name='ludolph_ansible-output')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _split(self, line):
+        """Cut lines which would not fit into one message on character boundaries; yield (chunk, size in bytes)"""
+        data = _text(line).encode('utf-8')
+
+        while len(data) > self.max_size:
+            end = _char_start(data, self.max_size) or self.max_size  # max_size is smaller than one character
+
+            while end < len(data) and _char_start(data, end) != end:
+                end += 1
+
+            yield data[:end].decode('utf-8'), end
+            data = data[end:]
+
+        yield data.decode('utf-8'), len(data)
+
+    def _send_lines(self, lines):
+        if lines:
+            try:
+                self.send_fun('\n'.join(lines))
+            except Exception as exc:
+                logger.exception(exc)
+
+    def _rendered(self, pending, last):
+        """Yield rendered pending lines followed by lines returned by the optional render.flush(last) method"""
+        while pending:
+            text, color = pending.popleft()
+
+            try:
+                rendered = self.render(text, color)
+            except Exception as exc:
+                logger.exception(exc)
+                continue
+
+            for line in rendered:
+                yield line
+
+        flush = getattr(self.render, 'flush', None)
+
+        if flush is not None:
+            try:
+                rendered = flush(last)
+            except Exception as exc:
+                logger.exception(exc)
+            else:
+                for line in rendered:
+                    yield line
+
+    def _send(self, pending, last=False):
+        """Render pending lines and send them"""
+        lines, size = [], 0
+
+        for line in self._rendered(pending, last):
+            for chunk, chunk_size in self._split(line):
+                chunk_size += 1
+
+                if lines and size + chunk_size > self.max_size:
+                    self._send_lines(lines)
+                    lines, size = [], 0
+
+                lines.append(chunk)
+                size += chunk_size
+
+        self._send_lines(lines)
+
+    def _write_log(self, text):
+        try:
+            if isinstance(text, text_type):
+                text = text.encode('utf-8')
+            elif not isinstance(text, binary_type):
+                text = str(text) or None  # Event; events which are not displayed have no text
+
+                if isinstance(text, text_type):
+                    text = text.encode('utf-8')
+
+            if text is not None:
+                self.log.write(text + b'\n')
+
+            if self._queue.empty():
+                self.log.flush()
+        except Exception as exc:
+            logger.exception(exc)
+
+    def _sender(self):
+        pending, deadline = deque(), None
+        send = self._send
+
+        if self.wrap_send is not None:
+            send = self.wrap_send(send)
+
+        while True:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(deadline - time.time(), 0)
+
+            try:
+                item = self._queue.get(True, timeout)
+            except Empty:
+                send(pending)
+                deadline = None
+                continue
+
+            if item is None:
+                break
+
+            if self.log is not None:
+                self._write_log(item[0])
+
+            pending.append(item)
+
+            if len(pending) >= self.buffer_size:
+                send(pending)
+                deadline = None
+            elif deadline is None:
+                deadline = time.time() + self.interval
+
+        send(pending, True)
+
+    def write(self, text, color=None):
+        if self._thread is None and self._pid == os.getpid():
+            self._start()
+
+        self._queue.put((text, color))
+
+    def flush(self):
+        """Send all pending lines and wait until they are sent"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def close(self):
+        self.flush()
+        self._queue.close()
+
+        if self.log is not None:
+            self.log.close()
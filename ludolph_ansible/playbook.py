@@ -7,19 +7,73 @@ See the LICENSE file for copying permission.
 """
 from __future__ import absolute_import
 from __future__ import print_function
+import math
+import time
+import logging
+import multiprocessing
 from os import path
-
+from threading import Lock, Thread, local
+from operator import itemgetter
+from functools import partial
+from fnmatch import fnmatch
+from itertools import chain, groupby
+from importlib import import_module
+
+from six import text_type
 from ludolph.command import CommandError, PermissionDenied, command
 from ludolph.plugins.plugin import LudolphPlugin
-
-from ansible import utils
-from ansible.errors import AnsibleError
-from ansible.inventory import Inventory
-from ansible.playbook import PlayBook
-from ansible.playbook.play import Play
+from ludolph.web import WEBHOOKS, webhook
 
 from . import __version__
-from .playbook_callbacks import banner, AggregateStats, PlaybookCallbacks, PlaybookRunnerCallbacks
+from .cache import InventoryCache, PlaybookCache
+from .history import RunHistory
+from .index import PlaybookIndex
+from .jobs import Job, JobCancelled, JobManager, JobQueueFull, OwnerQueueFull
+from .lazy import LazyModule
+from .metrics import Metrics, WAIT_BUCKETS
+from .output import OutputChannel
+from .runlog import RunLogs
+from .timing import RunTimer, estimate_plays
+from .playbook_callbacks import (banner, AggregateStats, Event, TaskBanner, PlaybookCallbacks,
+                                 PlaybookRunnerCallbacks)
+
+logger = logging.getLogger(__name__)
+constants = LazyModule('ansible.constants')
+utils = LazyModule('ansible.utils')
+_runner_local = local()
+
+
+def _patch_ansible_runner():
+    """
+    Runner.run() publishes itself in the multiprocessing_runner global before forking its workers, which is not
+    safe when several playbooks run in parallel threads. Make the forked workers use the runner from their own thread.
+    """
+    import ansible.runner
+
+    if getattr(ansible.runner, '_ludolph_patched', False):
+        return
+
+    parallel_exec = ansible.runner.Runner._parallel_exec
+    executor_hook = ansible.runner._executor_hook
+
+    def _parallel_exec(self, hosts):
+        _runner_local.runner = self
+        try:
+            return parallel_exec(self, hosts)
+        finally:
+            _runner_local.runner = None
+
+    def _executor_hook(*args):
+        runner = getattr(_runner_local, 'runner', None)  # Thread locals survive the fork in the forking thread
+
+        if runner is not None:
+            ansible.runner.multiprocessing_runner = runner
+
+        return executor_hook(*args)
+
+    ansible.runner.Runner._parallel_exec = _parallel_exec
+    ansible.runner._executor_hook = _executor_hook
+    ansible.runner._ludolph_patched = True
 
 
 def _file(value):
@@ -38,6 +92,13 @@ def _bool(value):
         return True
 
 
+def _output_mode(value):
+    if value not in ('full', 'failures', 'progress'):
+        raise ValueError('Invalid output mode "%s"' % value)
+
+    return value
+
+
 def colorize(msg, color):
     msg2 = msg.rstrip(' ')
     end_spaces = len(msg) - len(msg2)
@@ -72,36 +133,152 @@ def hostcolor(host, stats):
     return stringc(host, color)
 
 
-class DisplayCallback(object):
+def render(msg, color=None):
+    """Chat lines displaying one line of output or one event"""
+    if isinstance(msg, Event):
+        return [stringc(text, color) if color else text for text, color in msg.lines()]
+
+    if isinstance(msg, TaskBanner):
+        msg = str(msg)
+
+    if color:
+        msg = stringc(msg, color)
+
+    return (msg,)
+
+
+def _is_banner(msg, color):
+    """True for lines displayed by banner()"""
+    return color is None and not isinstance(msg, (Event, TaskBanner)) and msg.startswith('\n')
+
+
+class FailureRender(object):
     """
-    Display task output.
+    Chat lines displaying only failures. The banner of a task is displayed before its first failure.
     """
-    buffer = []
+    def __init__(self):
+        self.banner = None
 
-    def __init__(self, display_fun=print):
-        self.display_fun = display_fun
+    def __call__(self, msg, color=None):
+        if color == 'red':
+            lines = render(msg, color)
 
-    # noinspection PyUnusedLocal,PyMethodMayBeStatic
-    def process_msg(self, msg, color=None, **kwargs):
-        if color:
-            msg = stringc(msg, color)
+            if self.banner is not None:
+                lines = (self.banner,) + tuple(lines)
+                self.banner = None
 
-        return msg
+            return lines
 
-    def save(self, msg, **kwargs):
-        self.buffer.append(self.process_msg(msg, **kwargs))
+        if isinstance(msg, TaskBanner):
+            self.banner = str(msg)
+        elif _is_banner(msg, color):
+            self.banner = msg
 
-    def flush(self):
-        if self.buffer:
-            self.display_fun('\n'.join(self.buffer))
-            del self.buffer[:]
-
-    def display(self, msg, flush=True, **kwargs):
-        if flush:
-            self.flush()
-            self.display_fun(self.process_msg(msg, **kwargs))
+        return ()
+
+
+class ProgressRender(FailureRender):
+    """
+    Chat lines displaying failures and at most one progress summary of the running task every interval seconds.
+    Summaries are added after a batch of lines is rendered (see flush()). The final summary of a task is displayed
+    when the task ends, but only if its progress was displayed before.
+    """
+    def __init__(self, interval=30):
+        super(ProgressRender, self).__init__()
+        self.interval = interval
+        self.task = None
+        self.done = set()
+        self.failed = set()
+        self.reported = None  # Last displayed summary of the running task
+        self.last_update = time.time()
+
+    def summary(self, now):
+        task, done = self.task, len(self.done)
+
+        if task.hosts:
+            res = '%s: %d/%d hosts done, %d failed' % (task.title, done, task.hosts, len(self.failed))
+
+            if 0 < done < task.hosts:
+                res += ', ETA %ds' % ((now - task.started) / done * (task.hosts - done))
         else:
-            self.save(msg, **kwargs)
+            res = '%s: %d hosts done, %d failed' % (task.title, done, len(self.failed))
+
+        return stringc(res, 'cyan')
+
+    def _end_task(self):
+        lines = ()
+
+        if self.reported is not None:
+            res = self.summary(time.time())
+
+            if res != self.reported:
+                lines = (res,)
+
+        self.task = None
+        self.reported = None
+        self.done.clear()
+        self.failed.clear()
+
+        return lines
+
+    def __call__(self, msg, color=None):
+        lines = ()
+
+        if isinstance(msg, TaskBanner) or _is_banner(msg, color):
+            lines = self._end_task()
+
+            if isinstance(msg, TaskBanner):
+                self.task = msg
+        elif isinstance(msg, Event) and msg.kind != 'diff':
+            self.done.add(msg.host)
+
+            if msg.kind in ('failed', 'unreachable'):
+                self.failed.add(msg.host)
+
+        return lines + tuple(super(ProgressRender, self).__call__(msg, color))
+
+    def flush(self, last=False):
+        """Lines displayed after a batch of lines; the last batch ends the running task"""
+        if last:
+            return self._end_task()
+
+        task, now = self.task, time.time()
+
+        if task is None or now - self.last_update < self.interval:
+            return ()
+
+        if not self.done and now - task.started < self.interval:  # The task has just started
+            return ()
+
+        res = self.summary(now)
+
+        if res == self.reported:
+            return ()
+
+        self.last_update = now
+        self.reported = res
+
+        return (res,)
+
+
+class DisplayCallback(object):
+    """
+    Display task output through a per-run output channel.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    # noinspection PyUnusedLocal
+    def display(self, msg, color=None, **kwargs):
+        self.channel.write(msg, color)
+
+    save = display
+
+    def flush(self):
+        self.channel.flush()
+
+    def close(self):
+        self.channel.close()
 
     __call__ = display
 
@@ -118,6 +295,7 @@ class Playbook(LudolphPlugin):
     )
 
     def __post_init__(self):
+        started = time.time()
         config = self.config
         basedir = path.abspath(path.realpath(config.get('basedir', '')))
 
@@ -130,6 +308,7 @@ class Playbook(LudolphPlugin):
         self.basedir = basedir
         self.options = {}
         self.playbooks = {}
+        self.inventory = None
         self.admin_required = _bool(config.get('restrict_playbooks', False))
         self.restrict_playbooks = _bool(config.get('restrict_playbooks', False))
 
@@ -137,11 +316,11 @@ class Playbook(LudolphPlugin):
         if inventory:
             if not path.isfile(inventory):
                 raise RuntimeError('inventory "%s" does not exist' % inventory)
-            self.options['inventory'] = Inventory(inventory)
+            self.inventory = inventory
         else:
             inventory = path.join(basedir, 'hosts.cfg')
             if path.exists(inventory):
-                self.options['inventory'] = Inventory(inventory)
+                self.inventory = inventory
 
         playbooks = config.get('playbooks', None)
         if playbooks:
@@ -165,26 +344,224 @@ class Playbook(LudolphPlugin):
                 else:
                     self.options[opt_name] = opt_value
 
-    def _get_callbacks(self, msg):
+        self.output_max_size = self._get_config('output_max_size', int, 16384)
+        self.output_interval = self._get_config('output_interval', float, 2.0)
+        self.output_buffer_size = self._get_config('output_buffer_size', int, 1000)
+        self.output_mode = self._get_config('output', _output_mode, 'full')
+        self.progress_interval = self._get_config('progress_interval', float, 30)
+        self.max_shards = self._get_config('max_shards', int, multiprocessing.cpu_count())
+        self.fact_cache_dir = config.get('fact_cache_dir', None)
+        self.fact_cache_ttl = self._get_config('fact_cache_ttl', float, 3600)
+        self.profile_dir = config.get('profile_dir', None)  # Profiles are not saved into the shared temporary dir
+
+        if self.profile_dir and not path.isdir(self.profile_dir):
+            raise RuntimeError('profile_dir "%s" does not exist' % self.profile_dir)
+
+        self._fact_store = None
+        self._file_digests = None
+
+        if self.fact_cache_dir and not path.isdir(self.fact_cache_dir):
+            raise RuntimeError('fact_cache_dir "%s" does not exist' % self.fact_cache_dir)
+        log_dir = config.get('log_dir', None)
+
+        if log_dir:
+            if not path.isdir(log_dir):
+                raise RuntimeError('log_dir "%s" does not exist' % log_dir)
+
+            self.run_logs = RunLogs(log_dir, keep=self._get_config('log_keep', int, 50))
+            first_job_id = self.run_logs.last_id() + 1
+        else:
+            self.run_logs = None
+            first_job_id = 1
+
+        self.jobs = JobManager(workers=self._get_config('max_jobs', int, 2),
+                               queue_size=self._get_config('max_queued_jobs', int, 0), first_id=first_job_id,
+                               owner_workers=self._get_config('max_jobs_per_user', int, 0),
+                               owner_queue_size=self._get_config('max_queued_jobs_per_user', int, 0))
+        priority_playbooks = config.get('priority_playbooks', '')
+        self.priority_playbooks = set(pb.strip() for pb in priority_playbooks.split(',') if pb.strip())
+        self.inventory_cache = InventoryCache(self.inventory)  # The ansible default inventory is used when not set
+        self.inventory_cache.watch(self._get_config('inventory_reload_interval', float, 30))
+        self.playbook_cache = PlaybookCache(self._new_playbook, size=self._get_config('playbook_cache_size', int, 32))
+        history_db = config.get('history_db', None)
+
+        if history_db:
+            self.history = RunHistory(history_db)
+        else:
+            self.history = None
+
+        self.index = PlaybookIndex(self.playbook_cache, self._get_playbook_paths())
+        self.metrics = self._new_metrics()
+        self.metrics_file = config.get('metrics_file', None)
+
+        # The webhook is not authenticated, so it is registered only when enabled
+        if self._get_config('metrics_webhook', _bool, False) and 'metrics_webhook' not in WEBHOOKS:
+            webhook('/ansible/metrics')(self.metrics_webhook.__func__)
+
+        self.last_failed_hosts = {}  # Playbook name -> hosts which failed or were unreachable in its last run
+        self.last_failed_tasks = {}  # Playbook name -> first task which failed in its last run or None
+        self._run_lock = Lock()
+
+        prewarm = self._get_config('prewarm', _bool, False)
+        index_on_startup = self._get_config('index_on_startup', _bool, False)
+
+        if prewarm or index_on_startup:
+            thread = Thread(target=self._prewarm, args=(prewarm, index_on_startup), name='ludolph_ansible-prewarm')
+            thread.daemon = True
+            thread.start()
+
+        logger.info('Playbook plugin initialized in %.3fs', time.time() - started)
+
+    def _prewarm(self, prewarm, index):
+        """Import ansible, parse the inventory and build the apb-find index in background"""
+        started = time.time()
+
+        try:
+            if prewarm:
+                _patch_ansible_runner()
+                import_module('ansible.playbook')
+                logger.info('Ansible imported in %.3fs', time.time() - started)
+                self.inventory_cache.list_hosts()
+                logger.info('Inventory parsed in %.3fs', time.time() - started)
+
+            if index:
+                self.index.refresh()
+                logger.info('Playbook index built in %.3fs', time.time() - started)
+        except Exception as exc:
+            logger.error('Could not prepare playbook plugin in background: %s', exc)
+
+    def __destroy__(self):
+        self.jobs.shutdown()
+        self.inventory_cache.stop()
+
+    def _get_config(self, name, check_fun, default):
+        """Get and validate plugin-level configuration option"""
+        value = self.config.get(name, None)
+
+        if value is None:
+            return default
+
+        try:
+            return check_fun(value)
+        except ValueError:
+            raise RuntimeError('invalid value for %s option in ludolph_ansible.playbook plugin configuration' % name)
+
+    @staticmethod
+    def _new_metrics():
+        metrics = Metrics()
+        metrics.counter('runs_started_total', 'Playbook runs started.')
+        metrics.counter('runs_finished_total', 'Playbook runs finished, failed or cancelled.')
+        metrics.histogram('run_duration_seconds', 'Duration of playbook runs.')
+        metrics.histogram('queue_wait_seconds', 'Time between submitting and starting a playbook job.',
+                          buckets=WAIT_BUCKETS)
+        metrics.counter('host_results_total', 'Task results of all hosts by status.')
+        metrics.counter('messages_sent_total', 'XMPP messages with playbook output.')
+        metrics.counter('message_bytes_sent_total', 'Size of XMPP messages with playbook output.')
+
+        return metrics
+
+    def _get_metrics_gauges(self):
+        jobs = self.jobs.all()
+
+        return (
+            ('jobs', 'Playbook jobs waiting or running.', [
+                ({'state': state}, len([job for job in jobs if job.state == state]))
+                for state in (Job.PENDING, Job.RUNNING)
+            ]),
+        )
+
+    def _write_metrics(self):
+        if self.metrics_file:
+            self.metrics.write(self.metrics_file, gauges=self._get_metrics_gauges())
+
+    def _check_permissions(self, msg):
+        if self.admin_required and not self.xmpp.is_jid_admin(self.xmpp.get_jid(msg)):
+            raise PermissionDenied
+
+    def _get_render(self, output_mode):
+        if output_mode == 'failures':
+            return FailureRender()
+
+        if output_mode == 'progress':
+            return ProgressRender(interval=self.progress_interval)
+
+        return render
+
+    def _send_output(self, msg, text):
+        """Send playbook output"""
+        self.metrics.inc('messages_sent_total')
+        self.metrics.inc('message_bytes_sent_total', len(text.encode('utf-8') if isinstance(text, text_type) else text))
+        self.xmpp.msg_reply(msg, text, preserve_msg=True)
+
+    def _reply_job(self, job, text):
+        """Send text to everyone waiting for job output"""
+        for msg in list(job.recipients):
+            self._send_output(msg, text)
+
+    def _get_callbacks(self, msg, job=None):
         stats = AggregateStats()
-        display = DisplayCallback(lambda text: self.xmpp.msg_reply(msg, text, preserve_msg=True))
+
+        if job is None:
+            send_fun = partial(self._send_output, msg)
+        else:
+            send_fun = partial(self._reply_job, job)
+
+        display = DisplayCallback(OutputChannel(send_fun,
+                                                max_size=self.output_max_size, interval=self.output_interval,
+                                                render=self._get_render(self.output_mode),
+                                                buffer_size=self.output_buffer_size))
 
         return {
             'stats': stats,
-            'callbacks': PlaybookCallbacks(verbose=utils.VERBOSITY, display=display),
+            'callbacks': PlaybookCallbacks(verbose=utils.VERBOSITY, display=display, job=job),
             'runner_callbacks': PlaybookRunnerCallbacks(stats, verbose=utils.VERBOSITY, display=display.save),
         }
 
-    @staticmethod
-    def _get_playbook_data(playbook):
-        return (Play(playbook, play_ds, play_basedir)
-                for play_ds, play_basedir in zip(playbook.playbook, playbook.play_basedirs))
+    def _get_playbook_paths(self):
+        """Get files of all configured playbooks"""
+        paths = {}
 
-    def _get_playbook(self, msg, pb_name):
-        """Get playbook by name"""
-        if self.admin_required and not self.xmpp.is_jid_admin(self.xmpp.get_jid(msg)):
-            raise PermissionDenied
+        for pb_alias in self.playbooks:
+            try:
+                paths[pb_alias] = self._resolve_playbook_path(pb_alias)
+            except CommandError as exc:
+                logger.warning('Ignoring playbook "%s": %s', pb_alias, exc.error_message)
+
+        return paths
+
+    def _get_playbook_key(self, pb_path):
+        """Playbook name used in run history"""
+        return path.relpath(pb_path, self.basedir)
+
+    def _get_run_logs(self):
+        if self.run_logs is None:
+            raise CommandError('Run logs are disabled')
+
+        return self.run_logs
 
+    def _get_fact_store(self):
+        if not self.fact_cache_dir:
+            raise CommandError('Fact cache is disabled')
+
+        if self._fact_store is None:
+            from .facts import FactStore
+            self._fact_store = FactStore(self.fact_cache_dir, ttl=self.fact_cache_ttl)
+
+        return self._fact_store
+
+    def _get_history(self):
+        if self.history is None:
+            raise CommandError('Run history is disabled')
+
+        return self.history
+
+    def _get_playbook_path(self, msg, pb_name):
+        """Get playbook file by name"""
+        self._check_permissions(msg)
+
+        return self._resolve_playbook_path(pb_name)
+
+    def _resolve_playbook_path(self, pb_name):
         try:
             pb_name = self.playbooks[pb_name]
         except KeyError:
@@ -202,15 +579,411 @@ class Playbook(LudolphPlugin):
         if not path.isfile(pb_path):
             raise CommandError('Playbook **%s** not found' % pb_name)
 
-        options = self._get_callbacks(msg)
+        return pb_path
+
+    def _new_playbook(self, pb_path, msg=None, job=None):
+        if msg is None:  # The playbook is only going to be parsed
+            stats = AggregateStats()
+            options = {
+                'stats': stats,
+                'callbacks': PlaybookCallbacks(),
+                'runner_callbacks': PlaybookRunnerCallbacks(stats),
+            }
+        else:
+            options = self._get_callbacks(msg, job=job)
+
         options.update(self.options)
+        options['inventory'] = self.inventory_cache.new()  # Every playbook run restricts and subsets its own inventory
+
+        return self._create_playbook(pb_path, options)
+
+    def _create_playbook(self, pb_path, options, refresh_facts=False):
+        _patch_ansible_runner()
+
+        if not self.fact_cache_dir:
+            from ansible.playbook import PlayBook
+            return PlayBook(playbook=pb_path, **options)
+
+        from .facts import CachedFactsPlayBook
+        return CachedFactsPlayBook(playbook=pb_path, fact_store=self._get_fact_store(), refresh_facts=refresh_facts,
+                                   **options)
+
+    def _get_playbook(self, msg, pb_name, job=None):
+        """Get playbook by name"""
+        return self._new_playbook(self._get_playbook_path(msg, pb_name), msg=msg, job=job)
+
+    def _get_playbook_info(self, msg, pb_name):
+        """Get parsed playbook plays and tasks by name"""
+        return self.playbook_cache.get(self._get_playbook_path(msg, pb_name))
+
+    def _get_playbook_hosts(self, pb_path, subset=None):
+        """Return set of all hosts used by a playbook"""
+        info = self.playbook_cache.get(pb_path)
+
+        return set(chain.from_iterable(self.inventory_cache.list_hosts(play.hosts, subset=subset)
+                                       for play in info.plays))
+
+    def _new_shard(self, pb, job, hosts):
+        """Create copy of a playbook which runs only on some hosts"""
+        display = pb.callbacks.display
+        stats = AggregateStats()
+        inventory = self.inventory_cache.new()
+        inventory.subset(','.join(hosts))
+        options = dict(self.options)
+        options.update({
+            'stats': stats,
+            'callbacks': PlaybookCallbacks(verbose=utils.VERBOSITY, display=display, job=job,
+                                           timer=pb.callbacks.timer),
+            'runner_callbacks': PlaybookRunnerCallbacks(stats, verbose=utils.VERBOSITY, display=display.save,
+                                                        timer=pb.runner_callbacks.timer),
+            'inventory': inventory,
+            'only_tags': pb.only_tags,
+            'check': pb.check,
+        })
+
+        shard = self._create_playbook(pb.filename, options, refresh_facts=getattr(pb.SETUP_CACHE, 'refresh', False))
+
+        if hasattr(pb.callbacks, 'start_at'):
+            shard.callbacks.start_at = pb.callbacks.start_at
+
+        return shard
+
+    def _run_shards(self, pb, job, shards):
+        """Split playbook hosts into shards and run every shard in its own process"""
+        from .shards import run_shards, split_hosts
+
+        hosts = sorted(self._get_playbook_hosts(pb.filename, subset=job.options.get('subset', None)))
+        groups = split_hosts(hosts, shards)
+        pb.callbacks.display('Running playbook on %d hosts in %d shards' % (len(hosts), len(groups)))
+
+        if groups:
+            run_shards([self._new_shard(pb, job, group) for group in groups], pb.stats, timer=pb.callbacks.timer,
+                       hosts=groups)
+        else:
+            pb.callbacks.on_no_hosts_matched()
+
+    def _get_job(self, msg, job_id):
+        """Get job by ID"""
+        self._check_permissions(msg)
+
+        try:
+            job = self.jobs.get(int(job_id))
+        except ValueError:
+            job = None
+
+        if job is None:
+            raise CommandError('Job **%s** does not exist' % job_id)
+
+        return job
+
+    def _job_info(self, job):
+        state = job.state
+
+        if job.duration is None:
+            duration = '-'
+        else:
+            duration = '%ds' % job.duration
+
+        if state == job.PENDING:
+            position = self.jobs.position(job)
+
+            if position is not None:
+                state += ' #%d, waiting %ds' % (position, time.time() - job.created)
+
+        return '**%s** %s [%s] (%s) %s' % (job.id, job.name, state, job.owner, duration)
+
+    def _get_job_priority(self, msg, playbook):
+        """Priority playbooks and jobs of admins are started before other pending jobs"""
+        priority = 0
+
+        if playbook in self.priority_playbooks:
+            priority += 2
+
+        if self.xmpp.is_jid_admin(self.xmpp.get_jid(msg)):
+            priority += 1
+
+        return priority
+
+    @staticmethod
+    def _get_recap(pb, job, profile=False):
+        res = [banner('PLAY RECAP: job %s (%s)' % (job.id, job.name))]
+
+        for h in sorted(pb.stats.processed.keys()):
+            t = pb.stats.summarize(h)
+            res.append('%s : ok=%-4s changed=%-4s unreachable=%-4s failed=%-4s' % (
+                hostcolor(h, t), t['ok'], t['changed'], t['unreachable'], t['failures']
+            ))
+
+        if profile:
+            res.append(banner('PROFILE'))
+            res.extend(pb.callbacks.timer.summary())
+
+        res.append('')
+
+        return '\n'.join(res)
+
+    def _save_history(self, pb, job, state):
+        options = job.options
+
+        try:
+            self.history.add(self._get_playbook_key(pb.filename), job.owner, state, job.started,
+                             time.time() - job.started, pb.stats, timer=pb.callbacks.timer,
+                             tags=options.get('tags', None), subset=options.get('subset', None), check=pb.check,
+                             mode=options.get('mode', None), forks=pb.forks, shards=int(options.get('shards', 1)))
+        except Exception as exc:
+            logger.error('Could not save job %s into run history: %s', job.id, exc)
+
+    def _get_last_failed_hosts(self, pb_path):
+        """Return hosts which failed or were unreachable in the last run of a playbook"""
+        pb_key = self._get_playbook_key(pb_path)
+        hosts = self.last_failed_hosts.get(pb_key, None)
+
+        if hosts is None and self.history is not None:  # The plugin was restarted since the last run
+            try:
+                hosts = self.history.last_failed_hosts(pb_key)
+            except Exception as exc:
+                logger.error('Could not read last run of playbook "%s" from run history: %s', pb_key, exc)
+
+        if hosts is None:
+            raise CommandError('Playbook **%s** has no previous run' % pb_key)
+
+        return set(hosts)
+
+    def _get_last_failed_task(self, pb_path):
+        """Return name of the task which failed first in the last run of a playbook"""
+        pb_key = self._get_playbook_key(pb_path)
+
+        if pb_key in self.last_failed_tasks:
+            task = self.last_failed_tasks[pb_key]
+        elif self.history is not None:  # The plugin was restarted since the last run
+            try:
+                task = self.history.last_failed_task(pb_key)
+            except Exception as exc:
+                logger.error('Could not read last run of playbook "%s" from run history: %s', pb_key, exc)
+                task = None
+        else:
+            task = None
+
+        if not task:
+            raise CommandError('No failed task in the last run of playbook **%s** to resume from' % pb_key)
+
+        return task
+
+    def _save_last_run(self, pb):
+        stats = pb.stats
+        pb_key = self._get_playbook_key(pb.filename)
+        self.last_failed_hosts[pb_key] = frozenset(
+            host for host in stats.processed if host in stats.failures or host in stats.dark)
+        self.last_failed_tasks[pb_key] = stats.failed_task[1] if stats.failed_task is not None else None
+
+    def _save_metrics(self, pb_key, pb, job, state):
+        metrics = self.metrics
+        metrics.inc('runs_finished_total', playbook=pb_key, state=state)
+        metrics.observe('run_duration_seconds', time.time() - job.started, playbook=pb_key)
+        totals = dict.fromkeys(('ok', 'changed', 'failed', 'unreachable', 'skipped'), 0)
+
+        for host_stats in pb.stats.processed.values():
+            totals['ok'] += host_stats.ok
+            totals['changed'] += host_stats.changed
+            totals['failed'] += host_stats.failures
+            totals['unreachable'] += host_stats.dark
+            totals['skipped'] += host_stats.skipped
+
+        for status, value in totals.items():
+            metrics.inc('host_results_total', value, playbook=pb_key, status=status)
+
+        self._write_metrics()
+
+    def _get_plugin_profile(self, profiler, job):
+        res = [banner('PLUGIN PROFILE')]
+        res.extend(profiler.summary())
+
+        if self.profile_dir:
+            file_path = profiler.dump(self.profile_dir, 'job-%d-' % job.id)
+
+            if file_path:
+                res.append('Full profile: %s' % file_path)
+
+        return '\n'.join(res)
+
+    def _run_playbook(self, pb, job, profile=False, shards=1, profiler=None):
+        """Run playbook in a job worker and display the results"""
+        from ansible.errors import AnsibleError
+
+        out = None
+        state = job.FAILED
+        timer = pb.callbacks.timer
+        display = pb.callbacks.display
+        pb_key = self._get_playbook_key(pb.filename)
+        self.metrics.inc('runs_started_total', playbook=pb_key)
+        self.metrics.observe('queue_wait_seconds', job.started - job.created)
+        self._write_metrics()
+
+        if self.run_logs is not None:
+            try:
+                display.channel.log = self.run_logs.open(job.id)
+            except (IOError, OSError) as exc:
+                logger.error('Could not create log of job %s: %s', job.id, exc)
+
+        # Only complete runs of all tasks show that a host is converged
+        record_fingerprints = self.history is not None and not pb.check and 'start_at' not in job.options
+
+        if record_fingerprints and job.fingerprints is None and job.hosts is not None:
+            try:
+                job.fingerprints = self._get_fingerprints(pb.filename, job.hosts, job.options.get('tags', 'all'))
+            except Exception as exc:
+                logger.error('Could not compute host fingerprints of job %s: %s', job.id, exc)
+
+        if shards > 1:
+            run = partial(self._run_shards, pb, job, shards)
+        else:
+            run = pb.run
+
+        if profiler is not None:
+            run = profiler.profile(run)
+            display.channel.wrap_send = profiler.profile
+            profiler.start()
+
+        try:
+            run()
+        except JobCancelled:
+            state = job.CANCELLED
+            out = 'Job **%s** (%s) was cancelled' % (job.id, job.name)
+            raise
+        except AnsibleError as exc:
+            out = str(CommandError('Ansible error: **%s**' % exc))
+            raise
+        except Exception as exc:
+            out = 'ERROR: Job **%s** (%s) failed due to internal programming error: %s' % (job.id, job.name, exc)
+            raise
+        else:
+            state = job.FINISHED
+        finally:
+            if timer is not None:  # Times of failed and cancelled runs are saved into history, too
+                timer.stop()
+
+            if state == job.FINISHED:
+                out = self._get_recap(pb, job, profile=profile)
+
+            if display.channel.log is not None:
+                out += '\nFull output: **apb-log %s**' % job.id
+
+            if profiler is not None:
+                profiler.stop()
+
+            display.close()
+
+            if profiler is not None:
+                out += '\n' + self._get_plugin_profile(profiler, job)
+
+            with self._run_lock:  # No more commands can be attached to the job
+                job.run_key = None
+
+            self._reply_job(job, out)
+
+            # Check runs of mode=plan-apply must not change hosts and tasks used by retry=last and resume=last
+            if state != job.CANCELLED and job.options.get('mode', None) != 'plan-apply':
+                self._save_last_run(pb)
+
+            if self.history is not None:
+                self._save_history(pb, job, state)
+
+                if record_fingerprints and job.fingerprints and state == job.FINISHED:
+                    self._save_fingerprints(pb_key, pb, job)
 
-        return PlayBook(playbook=pb_path, **options)
+            self._save_metrics(pb_key, pb, job, state)
+
+            if state == job.FINISHED and job.options.get('mode', None) == 'plan-apply':
+                self._plan_done(pb, job)
+
+    def _plan_done(self, pb, job):
+        """Apply changes found by a check run of a mode=plan-apply job or wait for apb-apply"""
+        stats = pb.stats
+        hosts = sorted(host for host in stats.changed.keys() if host not in stats.failures and host not in stats.dark)
+
+        if not hosts:
+            self._reply_job(job, 'Job **%s** (%s) found no pending changes, nothing to apply' % (job.id, job.name))
+            return
+
+        out = 'Job **%s** (%s) found pending changes on %d host(s): %s' % (job.id, job.name, len(hosts),
+                                                                          ', '.join(hosts))
+
+        if _bool(job.options.get('confirm', False)):
+            job.plan = hosts
+            self._reply_job(job, out + '\nApply them with: **apb-apply %s**' % job.id)
+        else:
+            try:
+                out += '\n' + self._apply_plan(job, hosts, job.recipients[0], recipients=job.recipients)
+            except CommandError as exc:
+                out += '\n' + str(exc)
+
+            self._reply_job(job, out)
+
+    def _apply_plan(self, job, hosts, msg, recipients=None):
+        """Submit the apply run of a mode=plan-apply job limited to hosts with pending changes"""
+        args = ['%s=%s' % (key, val) for key, val in job.options.items()
+                if key not in ('check', 'subset', 'retry', 'resume', 'mode', 'confirm', 'skip_converged')]
+        args.append('subset=%s' % ','.join(hosts))
+
+        return self._submit_playbook(msg, job.name, args, recipients=recipients)
+
+    @staticmethod
+    def _get_tags_key(tags):
+        return ','.join(sorted(tag.strip() for tag in tags.split(',')))
+
+    def _get_fingerprints(self, pb_path, hosts, tags):
+        """Return host -> fingerprint of playbook and role files, tags and host and group variables"""
+        from .fingerprint import FileDigests, hash_files, host_fingerprints, playbook_files, vars_files
+
+        if self._file_digests is None:
+            self._file_digests = FileDigests()
+
+        files = self.playbook_cache.get(pb_path).files
+        files_hash = hash_files(playbook_files(files), self._file_digests)
+
+        return host_fingerprints(files_hash, self._get_tags_key(tags), self.inventory_cache.get(), hosts,
+                                 host_vars_files=vars_files(files), digests=self._file_digests)
+
+    def _save_fingerprints(self, pb_key, pb, job):
+        try:
+            self.history.save_fingerprints(pb_key, job.fingerprints, pb.stats, time.time())
+        except Exception as exc:
+            logger.error('Could not save host fingerprints of job %s: %s', job.id, exc)
+
+    def _get_run_key(self, pb_path, options):
+        """Options which make a playbook run different from another run of the same playbook"""
+        opts = dict((key, val) for key, val, _ in options)
+        tags = self._get_tags_key(opts.get('tags', 'all'))
+        check = _bool(opts.get('check', self.options.get('check', False)))
+
+        profile = opts.get('profile', 'no')
+
+        if profile != 'plugin':
+            profile = _bool(profile)
+
+        return (pb_path, tags, opts.get('subset', None), check, opts.get('facts', None), opts.get('retry', None),
+                opts.get('start_at', None), opts.get('resume', None), opts.get('mode', None),
+                _bool(opts.get('confirm', False)), _bool(opts.get('skip_converged', False)), profile,
+                int(opts.get('shards', 1)), opts.get('output', self.output_mode))
+
+    def _attach_job(self, msg, run_key, lock=True):
+        """Find pending or running job with the same run key and send its output also to the sender of msg"""
+        if lock:
+            with self._run_lock:
+                return self._attach_job(msg, run_key, lock=False)
+
+        for job in self.jobs.all():
+            if job.run_key == run_key and not (job.done or job.cancelled):
+                job.recipients.append(msg)
+                return job
+
+        return None
 
     @command
     def apb(self, msg, playbook, *args):
         """
-        Run an ansible playbook and display the results.
+        Run an ansible playbook in background and display the results. Identical commands submitted while the
+        playbook is waiting or running are attached to the existing job.
 
         Usage: apb <playbook> [options]
 
@@ -218,8 +991,24 @@ class Playbook(LudolphPlugin):
             tags=tag1,tag2,...
             check=no
             subset=*domain1*
+            profile=no|yes|plugin (plugin: profile of the plugin code; admins only)
+            output=full|failures|progress
+            shards=1
+            facts=refresh
+            retry=last (run only on hosts which failed or were unreachable in the last run)
+            start_at=<task name or glob>
+            resume=last (start at the task which failed first in the last run)
+            mode=plan-apply (run in check mode first and then apply only to hosts with pending changes)
+            confirm=no (with mode=plan-apply: wait for apb-apply before applying the changes)
+            skip_converged=no (skip hosts without changes in the last run and with unchanged inputs)
         """
-        pb = self._get_playbook(msg, playbook)
+        msg = self.xmpp.msg_copy(msg)  # The job replies after the original message is gone
+
+        return self._submit_playbook(msg, playbook, args)
+
+    def _parse_options(self, msg, args):
+        """Parse and validate apb command arguments; return list of (key, value, argument)"""
+        options = []
 
         for arg in args:
             try:
@@ -227,34 +1016,485 @@ class Playbook(LudolphPlugin):
             except ValueError:
                 raise CommandError('Invalid option: **%s**' % arg)
             else:
-                key, val = key.strip(), val.strip()
+                options.append((key.strip(), val.strip(), arg))
+
+        keys = set(key for key, _, _ in options)
+
+        for key, val, arg in options:
+            if key in ('tags', 'check', 'subset', 'start_at'):
+                pass
+            elif key == 'profile':
+                if val == 'plugin' and not self.xmpp.is_jid_admin(self.xmpp.get_jid(msg)):
+                    raise PermissionDenied
+            elif key == 'output':
+                try:
+                    _output_mode(val)
+                except ValueError:
+                    raise CommandError('Invalid output mode: **%s**' % val)
+            elif key == 'facts':
+                self._get_fact_store()
+
+                if val != 'refresh':
+                    raise CommandError('Invalid option: **%s**' % arg)
+            elif key == 'shards':
+                try:
+                    shards = int(val)
+                except ValueError:
+                    shards = 0
+
+                if not 1 <= shards <= self.max_shards:
+                    raise CommandError('Number of shards must be between 1 and %d' % self.max_shards)
+            elif key in ('retry', 'resume'):
+                if val != 'last':
+                    raise CommandError('Invalid option: **%s**' % arg)
+            elif key == 'mode':
+                if val != 'plan-apply':
+                    raise CommandError('Invalid option: **%s**' % arg)
+
+                if 'check' in keys:
+                    raise CommandError('Options mode and check cannot be used together')
+            elif key == 'skip_converged':
+                self._get_history()
+            elif key == 'confirm':
+                if 'mode' not in keys:
+                    raise CommandError('Option confirm can be used only with mode=plan-apply')
+            else:
+                raise CommandError('Invalid option: **%s**' % arg)
+
+        if 'start_at' in keys and 'resume' in keys:
+            raise CommandError('Options start_at and resume cannot be used together')
 
+        return options
+
+    def _submit_playbook(self, msg, playbook, args, recipients=None):
+        """Create playbook job from apb command arguments and submit it"""
+        options = self._parse_options(msg, args)  # Before attaching, so that invalid commands are not attached
+        run_key = self._get_run_key(self._get_playbook_path(msg, playbook), options)
+        job = self._attach_job(msg, run_key)
+
+        if job is not None:
+            return 'Identical playbook **%s** is already submitted as job **%s**, you will receive its output' % (
+                playbook, job.id)
+
+        job = Job(playbook, self.xmpp.get_jid(msg))
+        job.priority = self._get_job_priority(msg, playbook)
+        job.recipients.extend(recipients or (msg,))
+        pb = self._get_playbook(msg, playbook, job=job)
+        profile = False
+        profiler = None
+        shards = 1
+        retry = False
+        skip_converged = False
+
+        for key, val, _ in options:
             if key == 'tags':
                 pb.only_tags = map(str.strip, val.split(','))
             elif key == 'check':
                 pb.check = _bool(val)
             elif key == 'subset':
+                if not self.inventory_cache.list_hosts(subset=val):
+                    raise CommandError('No hosts matched subset: **%s**' % val)
                 pb.inventory.subset(val)
-            else:
-                raise CommandError('Invalid option: **%s**' % arg)
+            elif key == 'profile':
+                if val == 'plugin':
+                    from .profiler import PluginProfiler
+                    profiler = PluginProfiler()
+                else:
+                    profile = _bool(val)
+            elif key == 'output':
+                pb.callbacks.display.channel.render = self._get_render(val)
+            elif key == 'facts':
+                pb.SETUP_CACHE.refresh = True
+            elif key == 'shards':
+                shards = int(val)
+            elif key == 'retry':
+                retry = True
+            elif key == 'start_at':
+                pb.callbacks.start_at = val
+            elif key == 'resume':
+                pb.callbacks.start_at = job.options['start_at'] = self._get_last_failed_task(pb.filename)
+            elif key == 'mode':
+                pb.check = True
+            elif key == 'skip_converged':
+                skip_converged = _bool(val)
+
+            job.options[key] = val
+
+        if retry:
+            hosts = self._get_last_failed_hosts(pb.filename)
+            subset = job.options.get('subset', None)
+
+            if subset:
+                hosts.intersection_update(self.inventory_cache.list_hosts(subset=subset))
+
+            if not hosts:
+                raise CommandError('No failed or unreachable hosts from the last run of playbook **%s** to retry' %
+                                   playbook)
+
+            job.options['subset'] = ','.join(sorted(hosts))
+            pb.inventory.subset(job.options['subset'])
+
+        if skip_converged:
+            hosts = self._get_playbook_hosts(pb.filename, subset=job.options.get('subset', None))
+            job.fingerprints = self._get_fingerprints(pb.filename, hosts, job.options.get('tags', 'all'))
+            converged = self.history.converged_hosts(self._get_playbook_key(pb.filename), job.fingerprints)
+
+            if converged:
+                hosts.difference_update(converged)
+
+                if not hosts:
+                    raise CommandError('All %d host(s) of playbook **%s** are converged, nothing to run' % (
+                        len(converged), playbook))
+
+                job.options['subset'] = ','.join(sorted(hosts))
+                pb.inventory.subset(job.options['subset'])
+        else:
+            converged = None
 
-        res = []
+        if profile or self.history is not None:
+            pb.callbacks.timer = pb.runner_callbacks.timer = RunTimer()
+
+        job.fun = partial(self._run_playbook, pb, profile=profile, shards=shards, profiler=profiler)
+        job.stats = pb.stats
+        job.run_key = run_key
+
+        try:
+            job.hosts = frozenset(self._get_playbook_hosts(pb.filename, subset=job.options.get('subset', None)))
+        except Exception as exc:  # The job will not run in parallel with other jobs
+            logger.error('Could not get hosts of playbook "%s": %s', pb.filename, exc)
+
+        with self._run_lock:
+            running_job = self._attach_job(msg, run_key, lock=False)  # Submitted while we were parsing the playbook
+
+            if running_job is None:
+                try:
+                    self.jobs.submit(job)
+                except OwnerQueueFull:
+                    raise CommandError('You have too many playbooks waiting to run, try again later')
+                except JobQueueFull:
+                    raise CommandError('Too many playbooks are waiting to run, try again later')
+
+        if running_job is not None:
+            return 'Identical playbook **%s** is already submitted as job **%s**, you will receive its output' % (
+                playbook, running_job.id)
+
+        out = 'Playbook **%s** was submitted as job **%s**' % (playbook, job.id)
+
+        if converged:
+            out += ' (%d converged host(s) skipped)' % len(converged)
+
+        waiting_for = self.jobs.waiting_for(job)
+
+        if waiting_for:
+            return out + ', waiting for job(s) using the same hosts: %s' % ', '.join('**%s**' % j.id
+                                                                                     for j in waiting_for)
+
+        position = self.jobs.position(job)
+
+        if position is not None and position > 1:
+            return out + ', position in queue: %d' % position
+
+        return out
+
+    @command
+    def apb_apply(self, msg, job_id):
+        """
+        Apply changes found by a playbook job submitted with mode=plan-apply confirm=yes.
+
+        Usage: apb-apply <job id>
+        """
+        job = self._get_job(msg, job_id)
+        user = self.xmpp.get_jid(msg)
+
+        if user != job.owner and not self.xmpp.is_jid_admin(user):
+            raise PermissionDenied
+
+        with self._run_lock:
+            hosts, job.plan = job.plan, None
+
+        if not hosts:
+            raise CommandError('Job **%s** has no pending changes to apply' % job.id)
+
+        return self._apply_plan(job, hosts, self.xmpp.msg_copy(msg))
+
+    def metrics_webhook(self):
+        """Playbook metrics in the Prometheus text format (registered as the /ansible/metrics webhook)"""
+        from bottle import response
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+        return self.metrics.render(gauges=self._get_metrics_gauges())
+
+    @command
+    def apb_jobs(self, msg):
+        """
+        List running and recently finished playbook jobs.
+
+        Usage: apb-jobs
+        """
+        self._check_permissions(msg)
+        jobs = self.jobs.all()
+
+        if not jobs:
+            return '(no jobs)'
+
+        return '\n'.join(self._job_info(job) for job in jobs)
+
+    @command
+    def apb_status(self, msg, job_id):
+        """
+        Show status of a playbook job.
+
+        Usage: apb-status <job id>
+        """
+        job = self._get_job(msg, job_id)
+        stats = job.stats
+        res = [self._job_info(job)]
+
+        if stats is not None:
+            hosts = list(stats.processed.keys())
+            failed = [h for h in hosts if h in stats.failures or h in stats.dark]
+            changed = [h for h in hosts if h in stats.changed]
+            res.append('hosts=%d changed=%d failed=%d' % (len(hosts), len(changed), len(failed)))
+
+        if job.error:
+            res.append('error: %s' % job.error)
+
+        return '\n'.join(res)
+
+    @command
+    def apb_cancel(self, msg, job_id):
+        """
+        Cancel a playbook job. A running job stops before its next task.
+
+        Usage: apb-cancel <job id>
+        """
+        job = self._get_job(msg, job_id)
+        user = self.xmpp.get_jid(msg)
+
+        if user != job.owner and not self.xmpp.is_jid_admin(user):
+            raise PermissionDenied
+
+        if job.done:
+            raise CommandError('Job **%s** is already %s' % (job.id, job.state))
+
+        self.jobs.cancel(job.id)
+
+        if job.state == job.CANCELLED:
+            out = 'Job **%s** (%s) was cancelled' % (job.id, job.name)
+
+            for recipient in list(job.recipients):  # Users who submitted or attached to the pending job
+                if self.xmpp.get_jid(recipient) != user:
+                    self._send_output(recipient, out)
+
+            return out
+        else:
+            return 'Job **%s** (%s) will be cancelled before its next task' % (job.id, job.name)
+
+    @command
+    def apb_log(self, msg, job_id, offset=0):
+        """
+        Show full output of a playbook job page by page. Negative offset is counted from the end of the log.
+
+        Usage: apb-log <job id> [offset]
+        """
+        self._check_permissions(msg)
+        run_logs = self._get_run_logs()
+
+        try:
+            job_id, offset = int(job_id), int(offset)
+        except ValueError:
+            raise CommandError('Invalid job ID or offset')
 
         try:
-            pb.run()
-            pb.callbacks.display.flush()
-            hosts = sorted(pb.stats.processed.keys())
-            res.append(banner(''))
+            data, next_offset, size = run_logs.read(job_id, offset=offset, size=self.output_max_size)
+        except (IOError, OSError):
+            raise CommandError('Log of job **%s** does not exist' % job_id)
+
+        res = [data.decode('utf-8', 'replace')]
+
+        if next_offset < size:
+            res.append('(%d/%d bytes, next page: **apb-log %s %d**)' % (next_offset, size, job_id, next_offset))
 
-            for h in hosts:
-                t = pb.stats.summarize(h)
-                res.append('%s : ok=%-4s changed=%-4s unreachable=%-4s failed=%-4s' % (
-                    hostcolor(h, t), t['ok'], t['changed'], t['unreachable'], t['failures']
-                ))
+        return '\n'.join(res)
+
+    @command
+    def apb_facts(self, msg, host, pattern=None):
+        """
+        Show cached facts of a host, optionally only facts matching a glob pattern.
+
+        Usage: apb-facts <host> [pattern]
+        """
+        self._check_permissions(msg)
+        fact_store = self._get_fact_store()
+        age = fact_store.age(host)
+        facts = fact_store.load(host)
+
+        if facts is None:
+            if age is None:
+                return 'No cached facts for host **%s**' % host
+
+            return 'Cached facts of host **%s** expired %ds ago' % (host, age - fact_store.ttl)
+
+        if pattern:
+            facts = dict((key, val) for key, val in facts.items() if fnmatch(key, pattern))
+
+        return '**%s**: facts cached %ds ago, expire in %ds\n%s' % (host, age, fact_store.ttl - age,
+                                                                     utils.jsonify(facts, format=True))
+
+    @staticmethod
+    def _format_time(timestamp):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
 
+    @command
+    def apb_history(self, msg, playbook, count=10):
+        """
+        Show latest runs of a playbook and hosts which failed in them.
+
+        Usage: apb-history <playbook> [count]
+        """
+        history = self._get_history()
+        pb_key = self._get_playbook_key(self._get_playbook_path(msg, playbook))
+
+        try:
+            count = int(count)
+        except ValueError:
+            raise CommandError('Invalid count: **%s**' % count)
+
+        runs = history.runs(pb_key, count=count)
+
+        if not runs:
+            return 'No runs of playbook **%s** found' % pb_key
+
+        res = ['', 'playbook: %s' % pb_key, '']
+        durations = []
+
+        for run in runs:
+            options = ''.join(' %s=%s' % (key, val) for key, val in (('tags', run.tags), ('subset', run.subset)) if val)
+
+            if run.check_mode:
+                options += ' check=yes'
+
+            if run.duration is not None:
+                durations.append(run.duration)
+
+            res.append('  #%d %s [%s] %ds hosts=%d changed=%d failed=%d (%s)%s' % (
+                run.id, self._format_time(run.started), run.state, run.duration or 0, run.hosts, run.changed_hosts,
+                run.failed_hosts, run.owner, options
+            ))
+
+        if durations:
             res.append('')
-        except AnsibleError as exc:
-            raise CommandError('Ansible error: **%s**' % exc)
+            res.append('  average duration: %ds, fastest: %ds, slowest: %ds' % (
+                sum(durations) / len(durations), min(durations), max(durations)
+            ))
+
+        failing_hosts = history.failing_hosts(pb_key, runs=count)
+
+        if failing_hosts:
+            res.append('')
+            res.append('failing hosts:')
+
+            for host, failed_runs in failing_hosts:
+                res.append('  %s: %d/%d runs' % (host, failed_runs, len(runs)))
+
+        res.append('')
+
+        return '\n'.join(res)
+
+    @command
+    def apb_host_history(self, msg, host, count=10):
+        """
+        Show latest playbook results of one host.
+
+        Usage: apb-host-history <host> [count]
+        """
+        self._check_permissions(msg)
+        history = self._get_history()
+
+        try:
+            count = int(count)
+        except ValueError:
+            raise CommandError('Invalid count: **%s**' % count)
+
+        res = []
+
+        for run in history.host_runs(host, count=count):
+            if run.duration is None:
+                duration = '-'
+            else:
+                duration = '%.2fs' % run.duration
+
+            res.append('#%d %s %s [%s] %s : ok=%-4s changed=%-4s unreachable=%-4s failed=%-4s' % (
+                run.run_id, self._format_time(run.started), run.playbook, run.state, duration, run.ok, run.changed,
+                run.unreachable, run.failures
+            ))
+
+        if not res:
+            return 'No runs for host **%s** found' % host
+
+        return '\n'.join(res)
+
+    @command
+    def apb_estimate(self, msg, playbook, *args):
+        """
+        Estimate duration of a playbook run from task times recorded in the run history.
+
+        Usage: apb-estimate <playbook> [tags=tag1,tag2,...] [subset=*domain1*] [forks=N] [shards=N]
+        """
+        history = self._get_history()
+        pb = self._get_playbook_info(msg, playbook)
+        pb_key = self._get_playbook_key(pb.filename)
+        tags = subset = None
+        forks = self.options.get('forks', None) or constants.DEFAULT_FORKS
+        shards = 1
+
+        for arg in args:
+            try:
+                key, val = (i.strip() for i in arg.split('='))
+
+                if key == 'tags':
+                    tags = set(tag.strip() for tag in val.split(','))
+                elif key == 'subset':
+                    subset = val
+                elif key == 'forks':
+                    forks = int(val)
+                elif key == 'shards':
+                    shards = int(val)
+                else:
+                    raise ValueError
+            except ValueError:
+                raise CommandError('Invalid option: **%s**' % arg)
+
+        if forks < 1:
+            raise CommandError('Number of forks must be at least 1')
+
+        if not 1 <= shards <= self.max_shards:
+            raise CommandError('Number of shards must be between 1 and %d' % self.max_shards)
+
+        runs, times = history.task_times(pb_key)
+
+        if not runs:
+            return 'No finished runs of playbook **%s** with recorded task times found' % pb_key
+
+        def play_hosts(play):
+            return int(math.ceil(len(self.inventory_cache.list_hosts(play.hosts, subset=subset)) / float(shards)))
+
+        estimates, unknown = estimate_plays(pb.plays, times, forks, play_hosts, tags=tags)
+        total = sum(estimate[0] for estimate in estimates)
+        res = ['', 'playbook: %s' % pb_key, '',
+               '  estimated duration: %ds (from %d latest runs, forks=%d, shards=%d)' % (total, runs, forks, shards)]
+
+        if unknown:
+            res.append('  tasks without recorded times: %d' % unknown)
+
+        res.append('')
+        res.append('critical path:')
+
+        for duration, play_name, task_name in sorted(estimates, reverse=True)[:10]:
+            res.append('  %8.2fs %3d%%  %s | %s' % (duration, duration * 100 / total if total else 0, play_name,
+                                                    task_name))
+
+        res.append('')
 
         return '\n'.join(res)
 
@@ -265,16 +1505,16 @@ class Playbook(LudolphPlugin):
 
         Usage: apb-tags <playbook>
         """
-        pb = self._get_playbook(msg, playbook)
+        pb = self._get_playbook_info(msg, playbook)
         i = 0
         res = ['', 'playbook: %s' % pb.filename, '']
 
-        for play in self._get_playbook_data(pb):
+        for play in pb.plays:
             i += 1
             res.append('  play #%d (%s):\tTAGS: [%s]' % (i, play.name, ','.join(sorted(set(play.tags)))))
             tags = set()
 
-            for task in pb.tasks_to_run_in_play(play):
+            for task in play.tasks:
                 tags.update(task.tags)
 
             res.append('    TASK TAGS: [%s]' % (', '.join(sorted(tags.difference(['untagged'])))))
@@ -289,20 +1529,20 @@ class Playbook(LudolphPlugin):
 
         Usage: apb-tasks <playbook> [tag]
         """
-        pb = self._get_playbook(msg, playbook)
+        pb = self._get_playbook_info(msg, playbook)
         i = 0
         res = ['', 'playbook: %s' % pb.filename, '']
 
         if tag:
             tag = tag.strip()
 
-        for play in self._get_playbook_data(pb):
+        for play in pb.plays:
             i += 1
             res.append('  play #%d (%s):\tTAGS: [%s]' % (i, play.name, ','.join(sorted(set(play.tags)))))
             num_tasks = 0
 
-            for task in pb.tasks_to_run_in_play(play):
-                if getattr(task, 'name', None) is not None:  # meta tasks have no names
+            for task in play.tasks:
+                if task.name is not None:  # meta tasks have no names
                     tags = set(task.tags).difference(['untagged'])
 
                     if tag and tag not in tags:
@@ -322,19 +1562,52 @@ class Playbook(LudolphPlugin):
         return '\n'.join(res)
 
     @command
-    def apb_hosts(self, msg, playbook):
+    def apb_find(self, msg, pattern):
+        """
+        Search tags, task names and roles in all configured playbooks.
+
+        Usage: apb-find [tag:|task:|role:]<pattern>
+        """
+        self._check_permissions(msg)
+        kinds = PlaybookIndex.KINDS
+        kind, sep, value = pattern.partition(':')
+
+        if sep and kind in kinds:
+            kinds = (kind,)
+            pattern = value.strip()
+
+        self.index.refresh()
+        res = []
+
+        for (kind, value), found in groupby(self.index.find(pattern, kinds=kinds), key=itemgetter(0, 1)):
+            res.append('%s **%s**: %s' % (kind, value, ', '.join('%s (play #%d)' % (pb_alias, play_no)
+                                                                 for _, _, pb_alias, play_no in found)))
+
+        if not res:
+            return 'No tags, tasks or roles matching **%s**' % pattern
+
+        return '\n'.join(res)
+
+    @command
+    def apb_hosts(self, msg, playbook, subset=None):
         """
         List all hosts available in a playbook.
 
-        Usage: apb-hosts <playbook>
+        Usage: apb-hosts <playbook> [subset]
         """
-        pb = self._get_playbook(msg, playbook)
+        pb = self._get_playbook_info(msg, playbook)
         i = 0
         res = ['', 'playbook: %s' % pb.filename, '']
 
-        for play in self._get_playbook_data(pb):
+        if subset:
+            subset = subset.strip()
+
+            if subset.startswith('subset='):
+                subset = subset[7:]
+
+        for play in pb.plays:
             i += 1
-            hosts = pb.inventory.list_hosts(play.hosts)
+            hosts = self.inventory_cache.list_hosts(play.hosts, subset=subset)
             res.append('  play #%d (%s): host count=%d' % (i, play.name, len(hosts)))
 
             for host in hosts:
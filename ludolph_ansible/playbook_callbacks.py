@@ -7,13 +7,16 @@ See the LICENSE file for copying permission.
 """
 from __future__ import absolute_import
 
+import time
 import fnmatch
 
 from six import text_type, iteritems
-from ansible import constants
-from ansible import utils
-from ansible.module_utils import basic
-from ansible.utils.unicode import to_bytes
+
+from .lazy import LazyModule
+
+constants = LazyModule('ansible.constants')
+utils = LazyModule('ansible.utils', 'ansible.utils.unicode')
+basic = LazyModule('ansible.module_utils.basic')
 
 
 # noinspection PyUnusedLocal
@@ -21,52 +24,150 @@ def display(msg, color=None, stderr=False, screen_only=False, log_only=False, ru
     print(msg)
 
 
+class HostStats(object):
+    """counters of one host"""
+    __slots__ = ('ok', 'failures', 'dark', 'changed', 'skipped')
+
+    def __init__(self):
+        self.ok = 0
+        self.failures = 0
+        self.dark = 0
+        self.changed = 0
+        self.skipped = 0
+
+    def merge(self, other):
+        self.ok += other.ok
+        self.failures += other.failures
+        self.dark += other.dark
+        self.changed += other.changed
+        self.skipped += other.skipped
+
+
+class HostStatsView(object):
+    """read-only host -> counter mapping of hosts with a non-zero counter"""
+    __slots__ = ('_hosts', '_attr')
+
+    def __init__(self, hosts, attr):
+        self._hosts = hosts
+        self._attr = attr
+
+    def get(self, host, default=None):
+        value = getattr(self._hosts.get(host, None), self._attr, 0)
+
+        if value:
+            return value
+
+        return default
+
+    def __getitem__(self, host):
+        value = self.get(host)
+
+        if value is None:
+            raise KeyError(host)
+
+        return value
+
+    def __contains__(self, host):
+        return bool(getattr(self._hosts.get(host, None), self._attr, 0))
+
+    def keys(self):
+        attr = self._attr
+
+        return [host for host, host_stats in iteritems(self._hosts) if getattr(host_stats, attr)]
+
+    def items(self):
+        attr = self._attr
+
+        return [(host, getattr(host_stats, attr)) for host, host_stats in iteritems(self._hosts)
+                if getattr(host_stats, attr)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
 class AggregateStats(object):
     """holds stats about per-host activity during playbook runs"""
     def __init__(self):
-        self.processed = {}
-        self.failures = {}
-        self.ok = {}
-        self.dark = {}
-        self.changed = {}
-        self.skipped = {}
-
-    def _increment(self, what, host):
-        """helper function to bump a statistic"""
-        self.processed[host] = 1
-        prev = (getattr(self, what)).get(host, 0)
-        getattr(self, what)[host] = prev + 1
+        self.processed = {}  # host -> HostStats
+        self.failures = HostStatsView(self.processed, 'failures')
+        self.ok = HostStatsView(self.processed, 'ok')
+        self.dark = HostStatsView(self.processed, 'dark')
+        self.changed = HostStatsView(self.processed, 'changed')
+        self.skipped = HostStatsView(self.processed, 'skipped')
+        self.task = None  # (task number, name) of the running task; name is None while gathering facts
+        self.failed_task = None  # First task which failed or was unreachable on some host
+        self.aborted = False  # The run stopped because no hosts were left in a play
+
+    def _get(self, host):
+        """return counters of a host"""
+        try:
+            return self.processed[host]
+        except KeyError:
+            host_stats = self.processed[host] = HostStats()
+            return host_stats
+
+    def start_task(self, task_no, name):
+        """set the task whose results are computed next"""
+        self.task = (task_no, name)
+
+        if self.failed_task is not None and self.failed_task[1] is None:  # Failed while gathering facts
+            self.failed_task = self.task
+
+    def _task_failed(self):
+        if self.failed_task is None:
+            self.failed_task = self.task
 
     def compute(self, runner_results, setup=False, poll=False, ignore_errors=False):
         """walk through all results and increment stats"""
         for (host, value) in iteritems(runner_results.get('contacted', {})):
+            host_stats = self._get(host)
+
             if not ignore_errors and (
                         ('failed' in value and bool(value['failed'])) or
                         ('failed_when_result' in value and [value['failed_when_result']] or
                             ['rc' in value and value['rc'] != 0])[0]
             ):
-                self._increment('failures', host)
+                host_stats.failures += 1
+                self._task_failed()
             elif 'skipped' in value and bool(value['skipped']):
-                self._increment('skipped', host)
+                host_stats.skipped += 1
             elif 'changed' in value and bool(value['changed']):
                 if not setup and not poll:
-                    self._increment('changed', host)
-                self._increment('ok', host)
+                    host_stats.changed += 1
+                host_stats.ok += 1
             else:
                 if not poll or ('finished' in value and bool(value['finished'])):
-                    self._increment('ok', host)
+                    host_stats.ok += 1
+
+        for host in runner_results.get('dark', {}):
+            self._get(host).dark += 1
+            self._task_failed()
+
+    def merge(self, other):
+        """add stats collected by another AggregateStats object"""
+        for host, host_stats in iteritems(other.processed):
+            self._get(host).merge(host_stats)
 
-        for (host, value) in iteritems(runner_results.get('dark', {})):
-            self._increment('dark', host)
+        failed_task = other.failed_task
+
+        if failed_task is not None and (self.failed_task is None or failed_task[0] < self.failed_task[0]):
+            self.failed_task = failed_task
+
+        self.aborted = self.aborted or other.aborted
 
     def summarize(self, host):
         """return information about a particular host"""
+        host_stats = self.processed.get(host, None) or HostStats()
+
         return {
-            'ok': self.ok.get(host, 0),
-            'failures': self.failures.get(host, 0),
-            'unreachable': self.dark.get(host, 0),
-            'changed': self.changed.get(host, 0),
-            'skipped': self.skipped.get(host, 0)
+            'ok': host_stats.ok,
+            'failures': host_stats.failures,
+            'unreachable': host_stats.dark,
+            'changed': host_stats.changed,
+            'skipped': host_stats.skipped
         }
 
 
@@ -80,26 +181,54 @@ def banner(msg):
     return "\n%s %s " % (msg, filler)
 
 
-# noinspection PyUnusedLocal
-class PlaybookRunnerCallbacks(object):
-    """callbacks used for Runner() from ludolph playbook command"""
-    runner = None
+class TaskBanner(object):
+    """
+    banner displayed at the start of a task; it also holds the number of hosts running the task and the start time,
+    which are used for progress summaries
+    """
+    def __init__(self, title, hosts=None):
+        self.title = title
+        self.hosts = hosts
+        self.started = time.time()
 
-    # noinspection PyShadowingNames
-    def __init__(self, stats, verbose=None, display=display):
-        if verbose is None:
-            verbose = utils.VERBOSITY
+    def __str__(self):
+        return banner(self.title)
 
-        self.verbose = verbose
-        self.display = display
-        self.stats = stats
-        self._async_notified = {}
 
-    def on_unreachable(self, host, results):
-        if self.runner.delegate_to:
-            host = '%s -> %s' % (host, self.runner.delegate_to)
+class Event(object):
+    """
+    output of one runner callback which is rendered only when it is displayed; events are created in forked ansible
+    workers, so they should hold only data needed for rendering
+    """
+    __slots__ = ('kind', 'host', 'item', 'data', 'color', '_lines')
+
+    def __init__(self, kind, host, item=None, data=None, color=None):
+        self.kind = kind
+        self.host = host
+        self.item = item
+        self.data = data
+        self.color = color
+        self._lines = None
+
+    def __getstate__(self):
+        return self.kind, self.host, self.item, self.data, self.color
+
+    def __setstate__(self, state):
+        self.kind, self.host, self.item, self.data, self.color = state
+        self._lines = None
 
-        item = None
+    def __str__(self):
+        return '\n'.join(text for text, _ in self.lines())
+
+    def lines(self):
+        """return list of (text, color) tuples"""
+        if self._lines is None:
+            self._lines = getattr(self, '_render_' + self.kind)()
+
+        return self._lines
+
+    def _render_unreachable(self):
+        results, item = self.data, None
 
         if type(results) == dict:
             item = results.get('item', None)
@@ -109,20 +238,17 @@ class PlaybookRunnerCallbacks(object):
         else:
             results = utils.unicode.to_bytes(results)
 
-        host = utils.unicode.to_bytes(host)
+        host = utils.unicode.to_bytes(self.host)
 
         if item:
             msg = "fatal: [%s] => (item=%s) => %s" % (host, item, results)
         else:
             msg = "fatal: [%s] => %s" % (host, results)
 
-        self.display(msg, color='red', runner=self.runner)
+        return [(msg, self.color)]
 
-    def on_failed(self, host, results, ignore_errors=False):
-        if self.runner.delegate_to:
-            host = '%s -> %s' % (host, self.runner.delegate_to)
-
-        results2 = results.copy()
+    def _render_failed(self):
+        results2 = self.data.copy()
         results2.pop('invocation', None)
 
         item = results2.get('item', None)
@@ -137,78 +263,134 @@ class PlaybookRunnerCallbacks(object):
         returned_msg = results2.pop('msg', None)
 
         if item:
-            msg = "failed: [%s] => (item=%s) => %s" % (host, item, utils.jsonify(results2))
+            res = ["failed: [%s] => (item=%s) => %s" % (self.host, item, utils.jsonify(results2))]
         else:
-            msg = "failed: [%s] => %s" % (host, utils.jsonify(results2))
-
-        self.display(msg, color='red', runner=self.runner)
+            res = ["failed: [%s] => %s" % (self.host, utils.jsonify(results2))]
 
         if stderr:
-            self.display("stderr: %s" % stderr, color='red', runner=self.runner)
+            res.append("stderr: %s" % stderr)
         if stdout:
-            self.display("stdout: %s" % stdout, color='red', runner=self.runner)
+            res.append("stdout: %s" % stdout)
         if returned_msg:
-            self.display("msg: %s" % returned_msg, color='red', runner=self.runner)
+            res.append("msg: %s" % returned_msg)
         if not parsed and module_msg:
-            self.display(module_msg, color='red', runner=self.runner)
+            res.append(module_msg)
+
+        return [(msg, self.color) for msg in res]
+
+    def _render_ok(self):
+        if self.color == 'orange':
+            ok_or_changed = 'changed'
+        else:
+            ok_or_changed = 'ok'
+
+        if self.data is None:
+            if self.item:
+                msg = "%s: [%s] => (item=%s)" % (ok_or_changed, self.host, self.item)
+            else:
+                msg = "%s: [%s]" % (ok_or_changed, self.host)
+        else:
+            # verbose ...
+            host_result2 = self.data.copy()
+            host_result2.pop('invocation', None)
+            verbose_always = host_result2.pop('verbose_always', False)
+
+            if self.item:
+                msg = "%s: [%s] => (item=%s) => %s" % (ok_or_changed, self.host, self.item,
+                                                        utils.jsonify(host_result2, format=verbose_always))
+            else:
+                msg = "%s: [%s] => %s" % (ok_or_changed, self.host, utils.jsonify(host_result2, format=verbose_always))
+
+        return [(msg, self.color)]
+
+    def _render_skipped(self):
+        if self.item:
+            msg = "skipping: [%s] => (item=%s)" % (self.host, self.item)
+        else:
+            msg = "skipping: [%s]" % self.host
+
+        return [(msg, self.color)]
+
+    def _render_hidden(self):
+        return []
+
+    def _render_diff(self):
+        return [(utils.get_diff(self.data), self.color)]
+
+
+# noinspection PyUnusedLocal
+class PlaybookRunnerCallbacks(object):
+    """callbacks used for Runner() from ludolph playbook command; output is displayed as lazily rendered events"""
+    runner = None
+
+    # noinspection PyShadowingNames
+    def __init__(self, stats, verbose=None, display=display, timer=None):
+        if verbose is None:
+            verbose = utils.VERBOSITY
+
+        self.verbose = verbose
+        self.display = display
+        self.stats = stats
+        self.timer = timer
+        self._async_notified = {}
+
+    def _host_done(self, host):
+        if self.timer is not None:
+            self.timer.host_done(host)
+
+    def _host(self, host):
+        if self.runner.delegate_to:
+            return '%s -> %s' % (host, self.runner.delegate_to)
+
+        return host
+
+    def _event(self, kind, host, item=None, data=None, color=None):
+        self.display(Event(kind, host, item=item, data=data, color=color), color=color, runner=self.runner)
+
+    def on_unreachable(self, host, results):
+        self._host_done(host)
+        self._event('unreachable', self._host(host), data=results, color='red')
+
+    def on_failed(self, host, results, ignore_errors=False):
+        self._host_done(host)
+        self._event('failed', self._host(host), data=results, color='red')
+
         if ignore_errors:
             self.display("...ignoring", color='cyan', runner=self.runner)
 
     def on_ok(self, host, host_result):
-        if self.runner.delegate_to:
-            host = '%s -> %s' % (host, self.runner.delegate_to)
-
+        self._host_done(host)
         item = host_result.get('item', None)
-        host_result2 = host_result.copy()
-        host_result2.pop('invocation', None)
-        verbose_always = host_result2.pop('verbose_always', False)
-        changed = host_result.get('changed', False)
-        ok_or_changed = 'ok'
+        verbose_always = host_result.get('verbose_always', False)
 
-        if changed:
-            ok_or_changed = 'changed'
+        if host_result.get('changed', False):
+            color = 'orange'
+        else:
+            color = 'green'
 
         # show verbose output for non-setup module results if --verbose is used
-        msg = ''
-
-        if (not self.verbose or host_result2.get("verbose_override", None) is not None) and not verbose_always:
-            if item:
-                msg = "%s: [%s] => (item=%s)" % (ok_or_changed, host, item)
-            else:
-                if 'ansible_job_id' not in host_result or 'finished' in host_result:
-                    msg = "%s: [%s]" % (ok_or_changed, host)
+        if (not self.verbose or host_result.get("verbose_override", None) is not None) and not verbose_always:
+            data = None
         else:
-            # verbose ...
-            if item:
-                msg = "%s: [%s] => (item=%s) => %s" % (ok_or_changed, host, item, utils.jsonify(host_result2,
-                                                                                                format=verbose_always))
-            else:
-                if 'ansible_job_id' not in host_result or 'finished' in host_result2:
-                    msg = "%s: [%s] => %s" % (ok_or_changed, host, utils.jsonify(host_result2, format=verbose_always))
+            data = host_result
 
-        if msg != '':
-            if not changed:
-                self.display(msg, color='green', runner=self.runner)
-            else:
-                self.display(msg, color='orange', runner=self.runner)
+        if item or 'ansible_job_id' not in host_result or 'finished' in host_result:
+            self._event('ok', self._host(host), item=item, data=data, color=color)
 
-        if constants.COMMAND_WARNINGS and 'warnings' in host_result2 and host_result2['warnings']:
-            for warning in host_result2['warnings']:
+        if constants.COMMAND_WARNINGS and host_result.get('warnings', None):
+            for warning in host_result['warnings']:
                 self.display("warning: %s" % warning, color='purple', runner=self.runner)
 
     def on_skipped(self, host, item=None):
-        if self.runner.delegate_to:
-            host = '%s -> %s' % (host, self.runner.delegate_to)
+        self._host_done(host)
 
         if constants.DISPLAY_SKIPPED_HOSTS:
-            if item:
-                msg = "skipping: [%s] => (item=%s)" % (host, item)
-            else:
-                msg = "skipping: [%s]" % host
-
-            self.display(msg, color='cyan', runner=self.runner)
+            self._event('skipped', self._host(host), item=item, color='cyan')
+        else:
+            self._event('hidden', self._host(host), item=item)  # Counted in progress summaries
 
     def on_no_hosts(self):
+        self.stats.aborted = True
         self.display("FATAL: no hosts matched or all hosts have already failed -- aborting\n", color='red',
                      runner=self.runner)
 
@@ -230,16 +412,41 @@ class PlaybookRunnerCallbacks(object):
         self.display(msg, color='red', stderr=True, runner=self.runner)
 
     def on_file_diff(self, host, diff):
-        self.display(utils.get_diff(diff), runner=self.runner)
+        self._event('diff', host, data=diff)
 
 
 # noinspection PyMethodMayBeStatic
 class PlaybookCallbacks(object):
     """playbook.py callbacks used by ludolph playbook command"""
     # noinspection PyShadowingNames
-    def __init__(self, verbose=False, display=display):
+    def __init__(self, verbose=False, display=display, job=None, timer=None):
         self.verbose = verbose
         self.display = display
+        self.job = job
+        self.timer = timer
+        self._task_no = 0
+
+    def _start_task(self, name):
+        """tell the playbook stats which task is running (used for resuming from the first failed task)"""
+        stats = getattr(getattr(self, 'playbook', None), 'stats', None)
+
+        if stats is not None:
+            stats.start_task(self._task_no, name)
+
+    def _count_task_hosts(self):
+        """return number of play hosts which have not failed yet or None"""
+        play_hosts = getattr(getattr(self, 'play', None), '_play_hosts', None)
+        stats = getattr(getattr(self, 'playbook', None), 'stats', None)
+
+        if play_hosts is None or stats is None:
+            return None
+
+        return len([host for host in play_hosts if host not in stats.failures and host not in stats.dark])
+
+    def _check_cancelled(self):
+        """stop the playbook run if its job was cancelled"""
+        if self.job is not None:
+            self.job.check_cancelled()
 
     def on_start(self):
         pass
@@ -251,10 +458,18 @@ class PlaybookCallbacks(object):
         self.display("skipping: no hosts matched", color='cyan')
 
     def on_no_hosts_remaining(self):
+        stats = getattr(getattr(self, 'playbook', None), 'stats', None)
+
+        if stats is not None:
+            stats.aborted = True
+
         self.display("\nFATAL: all hosts have already failed -- aborting", color='red')
 
     # noinspection PyAttributeOutsideInit
     def on_task_start(self, name, is_conditional):
+        self._check_cancelled()
+        self._task_no += 1
+        task_name = name
         name = utils.unicode.to_bytes(name)
         msg = "TASK: [%s]" % name
 
@@ -280,14 +495,23 @@ class PlaybookCallbacks(object):
             self.skip_task = True
         else:
             self.skip_task = False
-            self.display(banner(msg))
+            self.display(TaskBanner(msg, hosts=self._count_task_hosts()))
+            self._start_task(task_name)
+
+            if self.timer is not None:
+                self.timer.task_start(task_name)
 
     def on_vars_prompt(self, varname, private=True, prompt=None, encrypt=None, confirm=False, salt_size=None,
                        salt=None, default=None):
         pass
 
     def on_setup(self):
+        self._check_cancelled()
         self.display(banner("GATHERING FACTS"))
+        self._start_task(None)
+
+        if self.timer is not None:
+            self.timer.task_start("GATHERING FACTS")
 
     def on_import_for_host(self, host, imported_file):
         msg = "%s: importing %s" % (host, imported_file)
@@ -298,7 +522,11 @@ class PlaybookCallbacks(object):
         self.display(msg, color='cyan')
 
     def on_play_start(self, name):
+        self._check_cancelled()
         self.display(banner("PLAY [%s]" % name))
 
+        if self.timer is not None:
+            self.timer.play_start(name)
+
     def on_stats(self, stats):
         pass
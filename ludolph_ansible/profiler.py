@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import pstats
+import marshal
+import logging
+import cProfile
+import tempfile
+from threading import Lock
+from functools import wraps
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_tracing_lock = Lock()
+_tracing_users = [0]  # Number of running profilers using tracemalloc, which is shared by the whole process
+
+
+class PluginProfiler(object):
+    """
+    Profile of the plugin code running during one playbook job. Functions wrapped by profile() (the playbook run in
+    the job thread and sending of output in the sender thread) are profiled by cProfile and memory allocations are
+    traced by tracemalloc (Python 3).
+    Runner callbacks called in forked ansible workers are not profiled.
+    """
+    def __init__(self):
+        self.profiles = []
+        self.snapshot = None
+        self._lock = Lock()
+        self._tracing = False
+
+    def profile(self, fun):
+        """Return function which runs fun under its own cProfile profiler; the wrapper can be called repeatedly"""
+        prof = cProfile.Profile()
+
+        with self._lock:
+            self.profiles.append(prof)
+
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            prof.enable()
+
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                prof.disable()
+
+        return wrapper
+
+    def start(self):
+        if tracemalloc is None:
+            return
+
+        with _tracing_lock:
+            if not _tracing_users[0]:
+                tracemalloc.start()
+
+            _tracing_users[0] += 1
+            self._tracing = True
+
+    def stop(self):
+        """Take snapshot of memory allocated by the plugin code"""
+        if not self._tracing:
+            return
+
+        with _tracing_lock:
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(True, os.path.join(PACKAGE_DIR, '*')),))
+            _tracing_users[0] -= 1
+            self._tracing = False
+
+            if not _tracing_users[0]:
+                tracemalloc.stop()
+
+    def _stats(self):
+        with self._lock:
+            profiles = list(self.profiles)
+
+        stats = None
+
+        for prof in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(prof)
+                else:
+                    stats.add(prof)
+            except TypeError:  # The profiled function was never called
+                pass
+
+        return stats
+
+    def summary(self, count=15):
+        """Return lines with plugin functions with the highest cumulative time and lines with the most memory"""
+        res = []
+        stats = self._stats()
+
+        if stats is not None:
+            functions = [(key, value) for key, value in stats.stats.items() if key[0].startswith(PACKAGE_DIR)]
+            functions.sort(key=lambda f: f[1][3], reverse=True)
+            res.append('cumulative      total      calls  function')
+
+            for (file_name, line_no, fun_name), (_, calls, total, cumulative, _) in functions[:count]:
+                res.append('%9.3fs %9.3fs %10d  %s:%d(%s)' % (cumulative, total, calls,
+                                                             os.path.relpath(file_name, PACKAGE_DIR), line_no,
+                                                             fun_name))
+
+        if self.snapshot is not None:
+            res.append('')
+            res.append('allocated      blocks  line')
+
+            for stat in self.snapshot.statistics('lineno')[:count]:
+                frame = stat.traceback[0]
+                res.append('%9.1fKiB %9d  %s:%d' % (stat.size / 1024.0, stat.count,
+                                                    os.path.relpath(frame.filename, PACKAGE_DIR), frame.lineno))
+
+        return res
+
+    def dump(self, dir_path, prefix):
+        """Save all profiles into a new file readable by pstats; return its path or None"""
+        stats = self._stats()
+
+        if stats is None:
+            return None
+
+        try:
+            fd, file_path = tempfile.mkstemp(suffix='.prof', prefix=prefix, dir=dir_path)  # O_EXCL, mode 0600
+
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(stats.stats, f)
+        except (IOError, OSError) as exc:
+            logger.error('Could not save plugin profile into "%s": %s', dir_path, exc)
+            return None
+
+        return file_path
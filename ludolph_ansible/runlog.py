@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import io
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RunLogs(object):
+    """
+    Directory with full output of the latest playbook jobs, one file per job. Oldest files are removed when a new one
+    is created.
+    """
+    file_name = 'job-%d.log'
+    file_re = re.compile(r'^job-(\d+)\.log$')
+
+    def __init__(self, log_dir, keep=50):
+        self.log_dir = log_dir
+        self.keep = keep
+
+    def path(self, job_id):
+        return os.path.join(self.log_dir, self.file_name % job_id)
+
+    def _job_ids(self):
+        job_ids = []
+
+        for f in os.listdir(self.log_dir):
+            match = self.file_re.match(f)
+
+            if match:
+                job_ids.append(int(match.group(1)))
+
+        return sorted(job_ids)
+
+    def last_id(self):
+        """Return ID of the latest logged job or 0; used for not overwriting logs after restart"""
+        job_ids = self._job_ids()
+
+        if job_ids:
+            return job_ids[-1]
+
+        return 0
+
+    def rotate(self, keep):
+        """Remove all but keep newest log files"""
+        job_ids = self._job_ids()
+
+        for job_id in job_ids[:max(len(job_ids) - keep, 0)]:
+            try:
+                os.remove(self.path(job_id))
+            except OSError as exc:
+                logger.error('Could not remove log of job %s: %s', job_id, exc)
+
+    def open(self, job_id):
+        """Return new binary log file of a job"""
+        self.rotate(max(self.keep - 1, 0))
+
+        return io.open(self.path(job_id), 'wb')
+
+    def read(self, job_id, offset=0, size=16384):
+        """
+        Return (data, next offset, file size). The file is read from offset (negative offset is counted from the end)
+        and data is cut at the last line boundary unless a single line is longer than size.
+        """
+        with io.open(self.path(job_id), 'rb') as f:
+            f.seek(0, io.SEEK_END)
+            total = f.tell()
+
+            if offset < 0:
+                offset = max(total + offset, 0)
+
+            f.seek(offset)
+            data = f.read(size)
+
+        if offset + len(data) < total:
+            eol = data.rfind(b'\n')
+
+            if eol >= 0:
+                data = data[:eol + 1]
+
+        return data, offset + len(data), total
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import logging
+from multiprocessing import Process, Queue
+
+from ansible.errors import AnsibleError
+from six.moves.queue import Empty
+
+from .jobs import JobCancelled
+from .timing import RunTimer
+
+logger = logging.getLogger(__name__)
+
+
+def split_hosts(hosts, shards):
+    """Split list of hosts into at most shards groups of (almost) the same size"""
+    return [hosts[i::shards] for i in range(min(shards, len(hosts)))]
+
+
+def _run_shard(shard_no, pb, results):
+    """Process target: run one playbook shard and send its stats and times to the parent"""
+    timer = pb.callbacks.timer
+
+    if timer is not None:  # Every shard process measures its own times
+        timer = pb.callbacks.timer = pb.runner_callbacks.timer = RunTimer()
+
+    try:
+        pb.run()
+    except JobCancelled:
+        error = 'cancelled'
+    except Exception as exc:
+        error = '%s' % exc
+    else:
+        error = None
+
+    if timer is not None:  # Times of failed and cancelled shards are kept, too
+        timer.stop()
+
+    results.put((shard_no, error, None if error else pb.stats, timer))
+
+
+def run_shards(playbooks, stats, timer=None, hosts=None):
+    """
+    Run each playbook in a separate process and merge their results into stats and timer. The playbooks share
+    the job, so all shards stop when the job is cancelled. hosts is a list of hosts planned for each playbook; a shard
+    whose hosts all failed in one play is aborted by ansible, and its hosts not processed by later plays are reported
+    as an error.
+    """
+    results = Queue()
+    processes = [Process(target=_run_shard, args=(i, pb, results), name='ludolph_ansible-shard-%d' % i)
+                 for i, pb in enumerate(playbooks)]
+    errors = {}
+    done = set()
+
+    for process in processes:
+        process.start()
+
+    while len(done) < len(processes):
+        try:
+            shard_no, error, shard_stats, shard_timer = results.get(True, 1)
+        except Empty:
+            if any(process.is_alive() for process in processes):
+                continue
+
+            try:  # Results of the last shards can be still on the way
+                shard_no, error, shard_stats, shard_timer = results.get(True, 1)
+            except Empty:
+                for i, process in enumerate(processes):
+                    if i not in done:
+                        errors[i] = 'process exited with code %s' % process.exitcode
+                break
+
+        done.add(shard_no)
+
+        if timer is not None and shard_timer is not None:
+            timer.merge(shard_timer)
+
+        if error is None:
+            stats.merge(shard_stats)
+
+            if shard_stats.aborted and hosts is not None:
+                skipped = sorted(set(hosts[shard_no]).difference(shard_stats.processed))
+
+                if skipped:
+                    errors[shard_no] = 'all hosts failed, not run on: %s' % ', '.join(skipped)
+        else:
+            errors[shard_no] = error
+
+    for process in processes:
+        process.join()
+
+    results.close()
+
+    if 'cancelled' in errors.values():
+        raise JobCancelled
+
+    if errors:
+        raise AnsibleError(', '.join('shard %d failed: %s' % (i, errors[i]) for i in sorted(errors)))
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import math
+import time
+from multiprocessing import Queue
+from operator import attrgetter
+
+from six import iteritems
+from six.moves.queue import Empty
+
+
+class TaskTime(object):
+    """wall-clock time of one task (or fact gathering) in a play"""
+    __slots__ = ('play', 'name', 'started', 'duration', 'host_times', 'slowest_host', 'slowest_host_duration')
+
+    def __init__(self, play, name, started):
+        self.play = play
+        self.name = name
+        self.started = started
+        self.duration = 0.0
+        self.host_times = {}  # host -> seconds (sum of all loop items)
+        self.slowest_host = None
+        self.slowest_host_duration = 0.0
+
+    @property
+    def hosts(self):
+        """number of hosts which ran the task; loop items of one host are not counted separately"""
+        return len(self.host_times)
+
+    def add_host_time(self, host, duration):
+        duration = self.host_times[host] = self.host_times.get(host, 0.0) + duration
+
+        if duration > self.slowest_host_duration:
+            self.slowest_host = host
+            self.slowest_host_duration = duration
+
+
+class RunTimer(object):
+    """
+    Collect wall-clock times of plays, tasks and hosts during a playbook run.
+
+    Host times are measured in the process calling the runner callbacks: the time since the task start or since the
+    previous result handled by the same forked ansible worker. Forked workers send their times back through
+    a multiprocessing queue, which is read by the parent process at the next task boundary.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.plays = []  # list of [play name, duration]
+        self.tasks = []  # list of TaskTime objects
+        self.hosts = {}  # host -> total seconds
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._task = None
+        self._mark = None
+
+    def _record(self, task_no, host, duration):
+        self.tasks[task_no].add_host_time(host, duration)
+        self.hosts[host] = self.hosts.get(host, 0.0) + duration
+
+    def _collect(self):
+        """Read host times sent by forked workers"""
+        while True:
+            try:
+                self._record(*self._queue.get_nowait())
+            except Empty:
+                break
+
+    def _stop_task(self, now):
+        self._collect()
+
+        if self._task is not None:
+            self._task.duration = now - self._task.started
+            self._task = None
+
+    def _stop_play(self, now):
+        self._stop_task(now)
+
+        if self.plays and self.plays[-1][1] is None:
+            self.plays[-1][1] = now - self.plays[-1][2]
+
+    def play_start(self, name):
+        now = time.time()
+        self._stop_play(now)
+        self.plays.append([name, None, now])
+
+    def task_start(self, name):
+        now = time.time()
+        self._stop_task(now)
+        play = self.plays[-1][0] if self.plays else None
+        self._task = TaskTime(play, name, now)
+        self.tasks.append(self._task)
+        self._mark = now
+
+    def host_done(self, host):
+        """Called by runner callbacks for every host result (also for each loop item)"""
+        if self._task is None:
+            return
+
+        now = time.time()
+        duration = now - self._mark
+        self._mark = now
+        task_no = len(self.tasks) - 1
+
+        if os.getpid() == self._pid:
+            self._record(task_no, host, duration)
+        else:
+            self._queue.put((task_no, host, duration))
+
+    def stop(self):
+        self.finished = time.time()
+        self._stop_play(self.finished)
+        self._queue.close()
+
+    def __getstate__(self):  # A stopped timer is sent from a shard process to the parent
+        state = dict((attr, getattr(self, attr)) for attr in ('started', 'finished', 'plays', 'tasks', 'hosts'))
+        state['tasks'] = [[getattr(task, attr) for attr in TaskTime.__slots__] for task in self.tasks]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tasks = []
+
+        for values in state['tasks']:
+            task = TaskTime(*values[:3])
+            task.duration, task.host_times, task.slowest_host, task.slowest_host_duration = values[3:]
+            self.tasks.append(task)
+
+        self._pid = self._queue = self._task = self._mark = None
+
+    def merge(self, other):
+        """Add times of a playbook run on other hosts, which ran at the same time (e.g. in another shard)"""
+        plays = dict((play[0], play) for play in self.plays)
+
+        for name, duration, started in other.plays:
+            play = plays.get(name, None)
+
+            if play is None:
+                play = plays[name] = [name, duration, started]
+                self.plays.append(play)
+            else:
+                play[1] = max(play[1] or 0, duration or 0)
+
+        tasks = dict(((task.play, task.name), task) for task in self.tasks)
+
+        for other_task in other.tasks:
+            task = tasks.get((other_task.play, other_task.name), None)
+
+            if task is None:
+                task = tasks[(other_task.play, other_task.name)] = TaskTime(other_task.play, other_task.name,
+                                                                            other_task.started)
+                self.tasks.append(task)
+
+            task.duration = max(task.duration, other_task.duration)
+
+            for host, duration in iteritems(other_task.host_times):
+                task.add_host_time(host, duration)
+
+        self.hosts.update(other.hosts)
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def slowest_tasks(self, count=10):
+        return sorted(self.tasks, key=attrgetter('duration'), reverse=True)[:count]
+
+    def slowest_hosts(self, count=10):
+        return sorted(iteritems(self.hosts), key=lambda x: x[1], reverse=True)[:count]
+
+    def summary(self, count=10):
+        """Return list of lines describing the slowest plays, tasks and hosts"""
+        res = ['plays:']
+
+        for name, duration, _ in self.plays:
+            res.append('  %8.2fs  %s' % (duration or 0, name))
+
+        res.append('slowest tasks:')
+
+        for task in self.slowest_tasks(count):
+            if task.slowest_host is None:
+                slowest = ''
+            else:
+                slowest = ' (hosts=%d, slowest: %s %.2fs)' % (task.hosts, task.slowest_host,
+                                                              task.slowest_host_duration)
+
+            res.append('  %8.2fs  %s | %s%s' % (task.duration, task.play, task.name, slowest))
+
+        res.append('slowest hosts:')
+
+        for host, duration in self.slowest_hosts(count):
+            res.append('  %8.2fs  %s' % (duration, host))
+
+        res.append('total: %.2fs' % self.duration)
+
+        return res
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _batches(hosts, forks, shards=1):
+    """Number of batches of forks hosts in one of shards processes"""
+    return int(math.ceil(math.ceil(float(max(hosts, 1)) / shards) / forks))
+
+
+def estimate_task(samples, hosts, forks):
+    """
+    Estimate wall-clock time of a task running on a number of hosts from (duration, hosts, slowest host duration,
+    forks, shards) samples of previous runs. Hosts run in batches of forks hosts, so the time of one batch is scaled
+    by the number of batches; the estimate is never shorter than the slowest host. All loop items of a host run in
+    the same batch. Samples of runs saved without forks and shards are normalized with forks and one shard.
+    """
+    if not hosts or not samples:
+        return 0.0
+
+    batch = _median([duration / _batches(task_hosts, run_forks or forks, run_shards or 1)
+                     for duration, task_hosts, _, run_forks, run_shards in samples])
+    slowest = _median([sample[2] for sample in samples])
+
+    return max(batch * _batches(hosts, forks), slowest)
+
+
+def task_display_name(task):
+    """Return name of a parsed task (TaskInfo) as displayed by ansible and recorded by RunTimer"""
+    if task.role:
+        return '%s | %s' % (task.role, task.name)
+
+    return task.name
+
+
+def estimate_plays(plays, times, forks, play_hosts, tags=None):
+    """
+    Estimate wall-clock times of tasks of parsed plays (PlayInfo) from task_times() samples. play_hosts(play) returns
+    the number of hosts of a play. Return list of (duration, play name, task name) and number of tasks without
+    samples.
+    """
+    estimates = []
+    unknown = 0
+
+    for play in plays:
+        hosts = play_hosts(play)
+
+        if not hosts:
+            continue
+
+        task_names = [task_display_name(task) for task in play.tasks if task.name is not None and
+                      (tags is None or 'all' in tags or tags.intersection(task.tags))]
+
+        if (play.name, 'GATHERING FACTS') in times:
+            task_names.insert(0, 'GATHERING FACTS')
+
+        for task_name in task_names:
+            samples = times.get((play.name, task_name), None)
+
+            if samples is None:
+                unknown += 1
+            else:
+                estimates.append((estimate_task(samples, hosts, forks), play.name, task_name))
+
+    return estimates, unknown
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+try:
+    import ansible.inventory
+    import ansible.playbook
+except ImportError:  # ansible < 2.0 supports only Python 2
+    ansible = None
+
+from ludolph_ansible.cache import InventoryCache, PlaybookCache
+from ludolph_ansible.playbook_callbacks import AggregateStats, PlaybookCallbacks, PlaybookRunnerCallbacks
+
+PLAYBOOK = '''
+- name: web servers
+  hosts: web
+  roles:
+    - nginx
+  tasks:
+    - name: play task
+      command: /bin/true
+'''
+
+
+def _write(file_path, content, age=0):
+    """Write file and set its mtime to age seconds in the past, so that every write changes the mtime"""
+    dir_path = os.path.dirname(file_path)
+
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+
+    with open(file_path, 'w') as f:
+        f.write(content)
+
+    mtime = time.time() - age
+    os.utime(file_path, (mtime, mtime))
+
+
+def _load_playbook(pb_path, hosts_file):
+    stats = AggregateStats()
+
+    return ansible.playbook.PlayBook(playbook=pb_path, stats=stats, callbacks=PlaybookCallbacks(),
+                                     runner_callbacks=PlaybookRunnerCallbacks(stats),
+                                     inventory=ansible.inventory.Inventory(hosts_file))
+
+
+def _role_tasks(*names):
+    return ''.join('- name: %s\n  command: /bin/true\n' % name for name in names)
+
+
+@unittest.skipIf(ansible is None, 'ansible is not installed')
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hosts_file = os.path.join(self.tmp_dir, 'hosts')
+        _write(self.hosts_file, '[web]\nweb1\nweb2\n', age=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp_dir, *parts)
+
+
+class PlaybookCacheTest(CacheTestCase):
+    def setUp(self):
+        super(PlaybookCacheTest, self).setUp()
+        self.loaded = []
+        self.cache = PlaybookCache(self._load, size=1)
+        _write(self.path('site.yml'), PLAYBOOK, age=60)
+        _write(self.path('other.yml'), PLAYBOOK, age=60)
+        _write(self.path('roles', 'nginx', 'tasks', 'main.yml'), _role_tasks('install nginx'), age=60)
+
+    def _load(self, pb_path):
+        self.loaded.append(pb_path)
+
+        return _load_playbook(pb_path, self.hosts_file)
+
+    def _task_names(self, pb_path):
+        return [task.name for task in self.cache.get(pb_path).plays[0].tasks if task.name]
+
+    def test_cached(self):
+        info = self.cache.get(self.path('site.yml'))
+        self.assertIs(self.cache.get(self.path('site.yml')), info)
+        self.assertEqual(len(self.loaded), 1)
+        self.assertIn(self.path('roles', 'nginx', 'tasks', 'main.yml'), info.files)
+
+    def test_role_file_changed(self):
+        self.assertEqual(self._task_names(self.path('site.yml')), ['install nginx', 'play task'])
+        _write(self.path('roles', 'nginx', 'tasks', 'main.yml'), _role_tasks('install nginx', 'configure nginx'))
+        self.assertEqual(self._task_names(self.path('site.yml')), ['install nginx', 'configure nginx', 'play task'])
+        self.assertEqual(len(self.loaded), 2)
+
+    def test_lru(self):
+        self.cache.get(self.path('site.yml'))
+        self.cache.get(self.path('other.yml'))
+        self.cache.get(self.path('site.yml'))
+        self.assertEqual(self.loaded, [self.path('site.yml'), self.path('other.yml'), self.path('site.yml')])
+
+
+class InventoryCacheTest(CacheTestCase):
+    def test_inventory_changed(self):
+        cache = InventoryCache(self.hosts_file)
+        inventory = cache.get()
+        self.assertEqual(sorted(cache.list_hosts('web')), ['web1', 'web2'])
+        self.assertIs(cache.get(), inventory)
+
+        _write(self.hosts_file, '[web]\nweb1\nweb2\nweb3\n')
+        self.assertEqual(sorted(cache.list_hosts('web')), ['web1', 'web2', 'web3'])
+        self.assertIsNot(cache.get(), inventory)
+
+    def test_host_vars_changed(self):
+        cache = InventoryCache(self.hosts_file)
+        self.assertEqual(sorted(cache.list_hosts('web', subset='web1')), ['web1'])
+        inventory = cache.get()
+
+        _write(self.path('host_vars', 'web1'), 'port: 8080\n')
+        self.assertIsNot(cache.get(), inventory)
+        self.assertEqual(cache.get().get_variables('web1')['port'], 8080)
+
+
+if __name__ == '__main__':
+    unittest.main()
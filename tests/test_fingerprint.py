@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import os
+import tempfile
+import unittest
+
+from ludolph_ansible.cache import InventoryCache, PlaybookCache
+from ludolph_ansible.fingerprint import FileDigests, hash_files, host_fingerprints, playbook_files, vars_files
+from tests.test_cache import CacheTestCase, _load_playbook, _write
+
+PLAYBOOK = '''
+- name: web servers
+  hosts: web
+  tasks:
+    - name: port
+      debug: msg="{{ port }}"
+'''
+
+
+class FingerprintTest(CacheTestCase):
+    """Inventory is in its own directory and the playbook has its own host_vars and group_vars"""
+    def setUp(self):
+        super(FingerprintTest, self).setUp()
+        inventory_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        self.hosts_file = os.path.join(inventory_dir, 'hosts')
+        _write(self.hosts_file, '[web]\nweb1\nweb2\n', age=60)
+        _write(self.path('site.yml'), PLAYBOOK, age=60)
+        _write(self.path('host_vars', 'web1.yml'), 'port: 80\n', age=60)
+        _write(self.path('host_vars', 'web2.yml'), 'port: 80\n', age=60)
+        _write(self.path('group_vars', 'web'), 'user: www\n', age=60)
+        self.inventory_cache = InventoryCache(self.hosts_file)
+        self.playbook_cache = PlaybookCache(lambda pb_path: _load_playbook(pb_path, self.hosts_file))
+        self.digests = FileDigests()
+
+    def _fingerprints(self):
+        files = self.playbook_cache.get(self.path('site.yml')).files
+        files_hash = hash_files(playbook_files(files), self.digests)
+
+        return host_fingerprints(files_hash, 'all', self.inventory_cache.get(), ('web1', 'web2'),
+                                 host_vars_files=vars_files(files), digests=self.digests)
+
+    def test_vars_files(self):
+        files = self.playbook_cache.get(self.path('site.yml')).files
+        self.assertNotIn(self.path('host_vars', 'web1.yml'), playbook_files(files))
+        self.assertIn((('host_vars', 'web1'), self.path('host_vars', 'web1.yml')), vars_files(files))
+        self.assertIn((('group_vars', 'web'), self.path('group_vars', 'web')), vars_files(files))
+
+    def test_host_vars_changed(self):
+        fingerprints = self._fingerprints()
+        _write(self.path('host_vars', 'web1.yml'), 'port: 8080\n')
+        changed = self._fingerprints()
+        self.assertNotEqual(changed['web1'], fingerprints['web1'])
+        self.assertEqual(changed['web2'], fingerprints['web2'])
+
+    def test_group_vars_changed(self):
+        fingerprints = self._fingerprints()
+        _write(self.path('group_vars', 'web'), 'user: nginx\n')
+        changed = self._fingerprints()
+        self.assertNotEqual(changed['web1'], fingerprints['web1'])
+        self.assertNotEqual(changed['web2'], fingerprints['web2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
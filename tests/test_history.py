@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from contextlib import closing
+
+from ludolph_ansible.history import RunHistory
+from ludolph_ansible.playbook_callbacks import AggregateStats
+from ludolph_ansible.timing import RunTimer, estimate_task
+
+TASK = 'inštalácia balíkov'
+
+
+class RunHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = RunHistory(os.path.join(self.tmp_dir, 'history.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _add_run(self, task_name, forks=None, shards=1):
+        stats = AggregateStats()
+        timer = RunTimer()
+        timer.play_start('play')
+        timer.task_start(task_name)
+        stats.start_task(1, task_name)
+        timer.host_done('host1')
+        stats.compute({'contacted': {'host1': {'failed': True}}})
+        timer.stop()
+
+        return self.history.add('site.yml', 'user@example.com', 'finished', timer.started, timer.duration, stats,
+                                timer=timer, forks=forks, shards=shards)
+
+    def test_non_ascii_task_name(self):
+        for task_name in (TASK, TASK.encode('utf-8')):  # ansible's to_bytes() creates byte strings on Python 2
+            self._add_run(task_name)
+
+        runs, times = self.history.task_times('site.yml')
+        self.assertEqual(runs, 2)
+        self.assertEqual(list(times.keys()), [('play', TASK)])
+        self.assertEqual(len(times[('play', TASK)]), 2)
+        self.assertEqual(self.history.last_failed_task('site.yml'), TASK)
+        self.assertEqual(self.history.last_failed_hosts('site.yml'), ['host1'])
+
+    def test_run_settings(self):
+        self._add_run(TASK, forks=5, shards=2)
+        runs, times = self.history.task_times('site.yml')
+        self.assertEqual(times[('play', TASK)][0][3:], (5, 2))
+
+    def test_estimate_forks_changed(self):
+        with closing(sqlite3.connect(self.history.db_file)) as db:
+            with db:
+                for run_id, forks in ((1, 10), (2, 5)):  # The same task took the same time with different forks
+                    db.execute('INSERT INTO runs (id, playbook, state, started, duration, forks, shards) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)', (run_id, 'site.yml', 'finished', run_id, 10.0, forks, 1))
+                    db.execute('INSERT INTO task_times (run_id, play, task, duration, hosts, slowest_host_duration) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (run_id, 'play', TASK, 10.0, 10, 1.0))
+
+        runs, times = self.history.task_times('site.yml')
+        samples = times[('play', TASK)]
+        self.assertEqual(runs, 2)
+        # One batch of 10s with forks=10 and two batches of 5s with forks=5
+        self.assertEqual(estimate_task(samples, 10, 10), 7.5)
+        self.assertEqual(estimate_task(samples, 10, 5), 15.0)
+        self.assertEqual(estimate_task(samples, 10, 2), 37.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import unittest
+from threading import Event
+
+from ludolph_ansible.jobs import Job, JobManager
+
+
+def _job(hosts=None, owner='user', priority=0, fun=None):
+    job = Job('site', owner, fun=fun)
+    job.hosts = None if hosts is None else frozenset(hosts)
+    job.priority = priority
+
+    return job
+
+
+class SchedulerTest(unittest.TestCase):
+    """Scheduling decisions of JobManager._next_job() without worker threads"""
+    def setUp(self):
+        self.manager = JobManager(workers=0)
+
+    def _submit(self, *args, **kwargs):
+        return self.manager.submit(_job(*args, **kwargs))
+
+    def _run(self, *args, **kwargs):
+        job = self._submit(*args, **kwargs)
+        self.assertIs(self._next(), job)
+        self.manager._running.append(job)
+
+        return job
+
+    def _next(self):
+        with self.manager._lock:
+            return self.manager._next_job()
+
+    def test_disjoint_hosts(self):
+        self._run(['web1', 'web2'])
+        job = self._submit(['db1'])
+        self.assertIs(self._next(), job)
+
+    def test_overlapping_hosts(self):
+        self._run(['web1', 'web2'])
+        self._submit(['web2'])
+        self.assertIsNone(self._next())
+
+    def test_later_disjoint_job_starts(self):
+        self._run(['web1'])
+        self._submit(['web1', 'web2'])
+        job = self._submit(['db1'])
+        self.assertIs(self._next(), job)
+
+    def test_waiting_job_reserves_its_hosts(self):
+        self._run(['web1'])
+        self._submit(['web1', 'web2'])
+        self._submit(['web2'])  # Would overtake the previous job using web2
+        self.assertIsNone(self._next())
+
+    def test_unknown_hosts_block_queue(self):
+        self._run(['web1'])
+        self._submit()
+        self._submit(['db1'])
+        self.assertIsNone(self._next())
+
+    def test_running_job_with_unknown_hosts(self):
+        self._run()
+        self._submit(['db1'])
+        self.assertIsNone(self._next())
+
+    def test_unknown_hosts_run_alone(self):
+        job = self._submit()
+        self.assertIs(self._next(), job)
+
+    def test_cancelled_job_does_not_block(self):
+        self._run(['web1'])
+        blocking = self._submit()
+        job = self._submit(['db1'])
+        blocking.cancel()
+        self.assertIs(self._next(), job)
+
+    def test_priority(self):
+        low = self._submit(['web1'])
+        high = self._submit(['web1'], priority=1)
+        self.assertIs(self._next(), high)
+        self.assertIs(self._next(), low)
+
+    def test_fair_share(self):
+        self._run(['web1'], owner='user1')
+        job1 = self._submit(['db1'], owner='user1')
+        job2 = self._submit(['db2'], owner='user2')
+        self.assertEqual(self.manager.position(job2), 1)
+        self.assertEqual(self.manager.position(job1), 2)
+        self.assertIs(self._next(), job2)
+
+    def test_owner_limit_does_not_starve_others(self):
+        self.manager.owner_workers = 1
+        self._run(['web1'], owner='user1')
+        self._submit(['db1'], owner='user1', priority=10)
+        job = self._submit(['db1'], owner='user2')  # The blocked high priority job does not reserve db1
+        self.assertIs(self._next(), job)
+
+
+class JobManagerTest(unittest.TestCase):
+    def test_disjoint_jobs_run_in_parallel(self):
+        manager = JobManager(workers=2)
+        started = [Event(), Event()]
+        finish = Event()
+
+        def fun(i):
+            def run(job):
+                started[i].set()
+                finish.wait(5)
+
+            return run
+
+        try:
+            manager.submit(_job(['web1'], fun=fun(0)))
+            manager.submit(_job(['db1'], fun=fun(1)))
+            self.assertTrue(started[0].wait(5))
+            self.assertTrue(started[1].wait(5))
+        finally:
+            finish.set()
+            manager.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import unittest
+from multiprocessing import Process
+
+from ludolph_ansible.output import OutputChannel
+from ludolph_ansible.playbook_callbacks import Event, TaskBanner
+
+try:
+    from ludolph_ansible.playbook import ProgressRender
+except ImportError:  # ludolph is not installed
+    ProgressRender = None
+
+
+def _write_lines(channel, lines):
+    for line in lines:
+        channel.write(line)
+
+
+class OutputChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = []
+
+    def _channel(self, **kwargs):
+        return OutputChannel(self.messages.append, **kwargs)
+
+    def _wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+
+        while len(self.messages) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_coalesce(self):
+        channel = self._channel(interval=3600)
+        _write_lines(channel, ['line %d' % i for i in range(10)])
+        channel.close()
+        self.assertEqual(self.messages, ['\n'.join('line %d' % i for i in range(10))])
+
+    def test_split_multibyte(self):
+        channel = self._channel(max_size=5, interval=3600)
+        line = 'šťa' * 7  # 2, 2 and 1 byte characters
+        channel.write(line)
+        channel.write(line.encode('utf-8'))
+        channel.close()
+        chunks = '\n'.join(self.messages).split('\n')
+
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk.encode('utf-8')), 5)
+
+        self.assertEqual(''.join(chunks), line * 2)
+
+    def test_mixed_text_and_bytes(self):
+        channel = self._channel(interval=3600)
+        channel.write('TASK: [inštalácia]'.encode('utf-8'))
+        channel.write('failed: [h2] => chyba')
+        channel.close()
+        self.assertEqual(self.messages, ['TASK: [inštalácia]\nfailed: [h2] => chyba'])
+
+    def test_interval_flush(self):
+        channel = self._channel(interval=0.05)
+        channel.write('first')
+        self._wait(1)
+        self.assertEqual(self.messages, ['first'])
+        channel.close()
+
+    def test_buffer_size_flush(self):
+        channel = self._channel(interval=3600, buffer_size=3)
+        _write_lines(channel, ['a', 'b', 'c', 'd'])
+        self._wait(1)
+        self.assertEqual(self.messages, ['a\nb\nc'])
+        channel.close()
+        self.assertEqual(self.messages, ['a\nb\nc', 'd'])
+
+    def test_forked_writer_order(self):
+        channel = self._channel(interval=3600)
+        channel.write('parent 1')
+        child = Process(target=_write_lines, args=(channel, ['child %d' % i for i in range(100)]))
+        child.start()
+        child.join()
+        channel.write('parent 2')
+        channel.close()
+        self.assertEqual(self.messages, ['\n'.join(['parent 1'] + ['child %d' % i for i in range(100)] +
+                                                   ['parent 2'])])
+
+
+@unittest.skipIf(ProgressRender is None, 'ludolph is not installed')
+class ProgressRenderTest(unittest.TestCase):
+    def setUp(self):
+        self.render = ProgressRender(interval=30)
+
+    def _batch(self, *lines):
+        """Render one batch of lines sent by OutputChannel after the interval has passed"""
+        self.render.last_update -= 30
+        res = [line for msg in lines for line in self.render(msg)]
+
+        return res + list(self.render.flush())
+
+    def test_summary_after_batch(self):
+        task = TaskBanner('TASK: [install]', hosts=2)
+        task.started -= 30
+        self.assertIn('TASK: [install]: 1/2 hosts done', self._batch(task, Event('ok', 'h1'))[0])
+        # Final count of the previous task, but no summary of the task which has just started
+        lines = self._batch(Event('ok', 'h2'), TaskBanner('TASK: [noop]', hosts=2))
+        self.assertEqual(len(lines), 1)
+        self.assertIn('TASK: [install]: 2/2 hosts done', lines[0])
+        # Skipped hosts are counted even when they are not displayed
+        lines = self._batch(Event('hidden', 'h1'), Event('hidden', 'h2'))
+        self.assertIn('TASK: [noop]: 2/2 hosts done', lines[0])
+        self.assertEqual(list(self.render.flush(last=True)), [])  # The final count was already displayed
+
+    def test_final_summary_at_end(self):
+        task = TaskBanner('TASK: [install]', hosts=2)
+        task.started -= 30
+        self._batch(task, Event('ok', 'h1'))
+        self.render(Event('failed', 'h2', data={'msg': 'error'}), 'red')
+        lines = list(self.render.flush(last=True))
+        self.assertEqual(len(lines), 1)
+        self.assertIn('TASK: [install]: 2/2 hosts done, 1 failed', lines[0])
+
+    def test_channel(self):
+        messages = []
+        channel = OutputChannel(messages.append, interval=3600, render=self.render)
+        channel.write(TaskBanner('TASK: [install]', hosts=1))
+        channel.write(Event('failed', 'h1', data={'msg': 'error'}), 'red')
+        channel.close()
+        self.assertEqual(len(messages), 1)
+        self.assertIn('failed: [h1]', messages[0])
+        self.assertNotIn('hosts done', messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+This file is part of Ludolph: Ansible plugin
+Copyright (C) 2015 Erigones, s. r. o.
+
+See the LICENSE file for copying permission.
+"""
+from __future__ import absolute_import
+
+import unittest
+
+from ludolph_ansible.cache import PlayInfo, TaskInfo
+from ludolph_ansible.timing import RunTimer, estimate_plays, estimate_task
+
+PLAYS = (
+    PlayInfo('web servers', (), 'web', (
+        TaskInfo('install nginx', ('nginx',), 'nginx'),
+        TaskInfo('loop', ('all',), None),
+        TaskInfo(None, (), None),  # meta task
+    )),
+)
+
+
+class RunTimerTest(unittest.TestCase):
+    def test_loop_items_are_not_hosts(self):
+        timer = RunTimer()
+        timer.play_start('web servers')
+        timer.task_start('loop')
+
+        for item in range(20):
+            for host in ('web1', 'web2', 'web3'):
+                timer.host_done(host)
+
+        timer.stop()
+        task = timer.tasks[0]
+        self.assertEqual(task.hosts, 3)
+        self.assertAlmostEqual(task.slowest_host_duration, task.host_times[task.slowest_host])
+
+    def test_merge(self):
+        timers = []
+
+        for host in ('web1', 'web2'):
+            timer = RunTimer()
+            timer.play_start('web servers')
+            timer.task_start('loop')
+            timer.host_done(host)
+            timer.host_done(host)
+            timer.stop()
+            timers.append(timer)
+
+        timers[0].merge(timers[1])
+        self.assertEqual(timers[0].tasks[0].hosts, 2)
+
+
+class EstimateTest(unittest.TestCase):
+    def test_estimate_task(self):
+        # 10 hosts with 20 loop items each took 10s with 5 forks, i.e. 2 batches of 5s
+        samples = [(10.0, 10, 5.0, 5, 1)]
+        self.assertEqual(estimate_task(samples, 10, 5), 10.0)
+        self.assertEqual(estimate_task(samples, 20, 5), 20.0)
+        self.assertEqual(estimate_task(samples, 1, 5), 5.0)
+        self.assertEqual(estimate_task(samples, 0, 5), 0.0)
+        self.assertEqual(estimate_task(samples, 10, 10), 5.0)
+
+    def test_estimate_task_run_settings(self):
+        # Every sample is normalized with forks and shards of its own run
+        samples = [(10.0, 20, 5.0, 10, 1), (5.0, 20, 5.0, 5, 4), (10.0, 20, 5.0, None, None)]
+        self.assertEqual(estimate_task(samples, 20, 10), 10.0)
+        self.assertEqual(estimate_task(samples[:2], 20, 5), 20.0)
+
+    def test_estimate_plays(self):
+        times = {
+            ('web servers', 'GATHERING FACTS'): [(2.0, 3, 1.0, 5, 1)],
+            ('web servers', 'nginx | install nginx'): [(4.0, 3, 4.0, 5, 1)],
+        }
+        estimates, unknown = estimate_plays(PLAYS, times, 5, lambda play: 3)
+        self.assertEqual(sorted(estimates), [(2.0, 'web servers', 'GATHERING FACTS'),
+                                             (4.0, 'web servers', 'nginx | install nginx')])
+        self.assertEqual(unknown, 1)
+
+        estimates, unknown = estimate_plays(PLAYS, times, 5, lambda play: 3, tags={'nginx'})
+        self.assertEqual(len(estimates), 2)
+        self.assertEqual(unknown, 0)
+
+        self.assertEqual(estimate_plays(PLAYS, times, 5, lambda play: 0), ([], 0))
+
+
+if __name__ == '__main__':
+    unittest.main()